@@ -15,10 +15,12 @@ setup(name='clusto-sgext',
         'kombu',
         'ostrich',
       ],
+      scripts=['bin/clusto-puppet-enc'],
       entry_points={
         'console_scripts': [
             'clusto-puppet-node2 = sgext.commands.puppet_node2:main',
             'clusto-barker-consumer = sgext.commands.barker_consumer:main',
+            'clusto-barker-bench = sgext.commands.barker_bench:main',
             'clusto-ec2-report = sgext.commands.ec2_report:main',
             'clusto-aws-cleanup = sgext.commands.aws_cleanup:main',
             'clusto-elb = sgext.commands.elb:main',
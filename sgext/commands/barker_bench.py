@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# © 2011 SimpleGeo, Inc. All rights reserved.
+#
+
+"""Record, replay and synthesize barker traffic to benchmark the
+barker consumer."""
+
+import ConfigParser
+import os
+import random
+import socket
+import sys
+import zlib
+from time import time
+
+import clusto
+from clusto import script_helper
+import eventlet
+from eventlet import tpool
+from eventlet.queue import Queue
+import kombu
+import simplejson as json
+
+from sgext.commands.barker_consumer import (
+    barker_callback, EntityCache, QUEUE_EXCHANGE, QUEUE_HOSTS, QUEUE_NAME,
+    QUEUE_PASSWORD, QUEUE_USER, QUEUE_VHOST)
+from sgext.util.connections import ratelimit, size_pool
+
+ZONES = ['us-east-1a', 'us-east-1b', 'us-east-1c', 'us-east-1d']
+ENVIRONMENTS = ['prod', 'staging', 'dev']
+ROLES = ['api', 'web', 'cassandra', 'hadoop', 'queue', 'solr']
+INSTANCE_TYPES = ['m1.large', 'm1.xlarge', 'm2.2xlarge', 'c1.xlarge']
+GB = 1073741824
+
+
+def percentile(values, pct):
+    """Return the pct'th percentile of the sorted list values."""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def synthetic_body(n, rng):
+    """Return a plausible barker message for the n'th synthetic instance."""
+    instance_id = 'i-%08x' % n
+    environment = rng.choice(ENVIRONMENTS)
+    role = rng.choice(ROLES)
+    local_ip = '10.%d.%d.%d' % (n >> 16 & 255, n >> 8 & 255, n & 255)
+    public_ip = '184.%d.%d.%d' % (n >> 16 & 255, n >> 8 & 255, n & 255)
+    cpus = rng.choice([2, 4, 8])
+    disks = [{'osname': 'sda1', 'mountpoint': '/', 'fstype': 'ext3',
+              'size': 10 * GB}]
+    for i, device in enumerate(['sdb', 'sdc', 'sdd', 'sde'][:rng.randint(1, 4)]):
+        disks.append({'osname': device, 'mountpoint': '/mnt%d' % i,
+                      'fstype': 'xfs', 'size': 420 * GB})
+
+    return {
+        'ec2': {
+            'instance-id': instance_id,
+            'placement': rng.choice(ZONES),
+            'ami-id': 'ami-%08x' % rng.randint(0, 15),
+            'kernel-id': 'aki-%08x' % rng.randint(0, 3),
+            'instance-type': rng.choice(INSTANCE_TYPES),
+            'local-hostname': 'ip-%s.ec2.internal' % local_ip.replace('.', '-'),
+            'public-hostname': 'ec2-%s.compute-1.amazonaws.com' % public_ip.replace('.', '-'),
+            'local-ipv4': local_ip,
+            'public-ipv4': public_ip,
+            'security-groups': ['default', '%s_%s' % (environment, role)],
+            'block-device-mapping': dict(
+                [('root', '/dev/sda1'), ('ami', 'sda1')] +
+                [('ephemeral%d' % i, '/dev/%s' % d['osname'])
+                 for i, d in enumerate(disks[1:])]),
+        },
+        'os': {
+            'hostname': '%s-%s-%d' % (environment, role, n),
+            'operatingsystemrelease': '10.04',
+            'kernelrelease': '2.6.32-309-ec2',
+            'memory': {'MemTotal': str(rng.choice([7, 15, 34]) * 1024 * 1024)},
+            'cpu': [{'model name': 'Intel(R) Xeon(R) CPU E5430 @ 2.66GHz',
+                     'cache size': '6144 KB'}] * cpus,
+            'disks': disks,
+        },
+        'sgmetadata': {
+            'clusterid': '%s-%s-%d' % (environment, role, n % 8),
+            'role': role,
+        },
+        'owners': {'ops': 'default owner'},
+    }
+
+
+def synthetic_fleet(count, seed=0):
+    """Return barker messages for a synthetic fleet of count instances."""
+    rng = random.Random(seed)
+    return [synthetic_body(n, rng) for n in range(count)]
+
+
+class BarkerBench(script_helper.Script):
+
+    """
+    Record, replay and synthesize barker traffic to benchmark the
+    barker consumer.
+    """
+
+    _usage = """
+             clusto-barker-bench record FILE [--count N]
+             clusto-barker-bench replay FILE [--rate N] [--bench-dsn DSN]
+                                             [--workers N]
+             clusto-barker-bench synthetic [--instances N] [--rounds N]
+                                           [--rate N] [--bench-dsn DSN]
+                                           [--workers N]
+
+             record: Append live barker messages from the first host in
+                     barker.hosts to FILE, one JSON document per line.
+             replay: Apply the messages recorded in FILE to the clusto
+                     database at DSN, at up to N messages per second.
+             synthetic: Generate a fleet of N instances and push it
+                        through kombu's in-memory transport into the
+                        consumer, --rounds times.
+
+             replay and synthetic report messages/sec, p50/p99
+             per-message latency and SQL queries per message. They
+             default to a fresh in-memory SQLite database, never to
+             the configured clusto database. --workers shards messages
+             across that many workers by instance-id, as the consumer
+             does; it needs a database with more than one connection,
+             and only speeds things up against MySQL.
+             """
+
+    def __init__(self):
+        script_helper.Script.__init__(self)
+        self.queries = 0
+
+    def _add_arguments(self, parser):
+        parser.add_argument('action', choices=['record', 'replay', 'synthetic'])
+        parser.add_argument('file', nargs='?', default=None)
+        parser.add_argument('--count', type=int, default=None,
+                            help='Stop recording after this many messages')
+        parser.add_argument('--rate', type=int, default=None,
+                            help='Apply at most this many messages per second')
+        parser.add_argument('--bench-dsn', default='sqlite://',
+                            help='Database to replay against')
+        parser.add_argument('--instances', type=int, default=1000,
+                            help='Size of the synthetic fleet')
+        parser.add_argument('--rounds', type=int, default=1,
+                            help='Number of times to send the synthetic fleet')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of DB workers to apply messages with')
+        parser.usage = self._usage
+
+    def add_subparser(self, subparsers):
+        parser = self._setup_subparser(subparsers)
+        self._add_arguments(parser)
+
+    def init_script(self, args, logger=None):
+        """
+        Only set up logging. Unlike other scripts, the bench never
+        connects to the configured clusto database; replay and
+        synthetic connect to --bench-dsn themselves.
+        """
+        if logger:
+            self.set_logger(logger)
+
+    def connect(self, dsn, workers=1):
+        """
+        Point clusto at dsn with a connection for each of workers, and
+        install a counter on every SQL statement executed against it.
+        """
+        from sqlalchemy import event
+
+        config = ConfigParser.SafeConfigParser()
+        config.add_section('clusto')
+        config.set('clusto', 'dsn', dsn)
+        clusto.connect(config)
+        if workers > 1:
+            if clusto.SESSION.bind.url.database in (None, '', ':memory:'):
+                raise StandardError('--workers needs a database file or server, '
+                                    'not in-memory SQLite')
+            size_pool(workers)
+            tpool.set_num_threads(workers)
+        clusto.init_clusto()
+
+        def count(*args, **kwargs):
+            self.queries += 1
+        event.listen(clusto.SESSION.bind, 'before_cursor_execute', count)
+
+    def apply(self, bodies, rate=None, workers=1):
+        """
+        Apply bodies one at a time on each of workers greenthreads and
+        print throughput stats.
+        """
+        if rate:
+            bodies = ratelimit(bodies, rate)
+        queues = [Queue() for i in range(workers)]
+        latencies = []
+
+        def worker(queue):
+            cache = EntityCache()
+            while True:
+                body = queue.get()
+                if body is None:
+                    return
+                before = time()
+                barker_callback(body, cache)
+                latencies.append((time() - before) * 1000)
+
+        def feed():
+            for body in bodies:
+                instance_id = body['ec2']['instance-id']
+                queues[zlib.crc32(instance_id) % workers].put(body)
+            for queue in queues:
+                queue.put(None)
+
+        pool = eventlet.GreenPool(workers)
+        for queue in queues[1:]:
+            pool.spawn_n(worker, queue)
+        queries = self.queries
+        start = time()
+        eventlet.spawn_n(feed)
+        # The first worker runs here: an in-memory database only exists
+        # on this greenthread's connection.
+        worker(queues[0])
+        pool.waitall()
+        elapsed = time() - start
+        queries = self.queries - queries
+
+        latencies.sort()
+        count = len(latencies)
+        print 'Workers: %d' % workers
+        print 'Messages: %d in %.2fs' % (count, elapsed)
+        print 'Messages/sec: %.1f' % (count / elapsed if elapsed else 0)
+        print 'Latency p50: %.2fms p99: %.2fms' % (percentile(latencies, 50),
+                                                  percentile(latencies, 99))
+        print 'Queries/message: %.1f' % (float(queries) / count if count else 0)
+
+    def _cmd_record(self, args):
+        if not args.file:
+            raise StandardError('record needs a FILE to write to')
+        exchange = kombu.Exchange(QUEUE_EXCHANGE, type='fanout',
+                                  delivery_mode='transient')
+        queue = kombu.Queue('%s-record-%d' % (QUEUE_NAME, os.getpid()),
+                            exchange, exclusive=True, auto_delete=True)
+        connection = kombu.BrokerConnection(hostname=QUEUE_HOSTS[0],
+                                            userid=QUEUE_USER,
+                                            password=QUEUE_PASSWORD,
+                                            virtual_host=QUEUE_VHOST)
+        output = open(args.file, 'a')
+        recorded = [0]
+
+        def record(body, message):
+            output.write(json.dumps(body, separators=(',', ':')) + '\n')
+            recorded[0] += 1
+
+        try:
+            consumer = kombu.Consumer(connection.channel(), queue,
+                                      callbacks=[record], no_ack=True)
+            consumer.consume()
+            while args.count is None or recorded[0] < args.count:
+                connection.drain_events()
+        finally:
+            output.close()
+            connection.release()
+
+    def _cmd_replay(self, args):
+        if not args.file:
+            raise StandardError('replay needs a FILE to read from')
+        bodies = [json.loads(line) for line in open(args.file) if line.strip()]
+        self.connect(args.bench_dsn, args.workers)
+        self.apply(bodies, args.rate, args.workers)
+
+    def _cmd_synthetic(self, args):
+        fleet = synthetic_fleet(args.instances, args.seed)
+        connection = kombu.BrokerConnection(transport='memory')
+        exchange = kombu.Exchange('barker-bench', type='fanout')
+        queue = kombu.Queue('barker-bench', exchange)
+        channel = connection.channel()
+        producer = kombu.Producer(channel, exchange=exchange, serializer='json')
+        queue(channel).declare()
+
+        received = []
+        consumer = kombu.Consumer(channel, queue, no_ack=True,
+                                  callbacks=[lambda body, message: received.append(body)])
+        consumer.consume()
+        for i in range(args.rounds):
+            for body in fleet:
+                producer.publish(body)
+        while True:
+            try:
+                connection.drain_events(timeout=1)
+            except socket.timeout:
+                break
+        connection.release()
+
+        self.connect(args.bench_dsn, args.workers)
+        self.apply(received, args.rate, args.workers)
+
+    def run(self, args):
+        try:
+            cmd = getattr(self, '_cmd_%s' % args.action)
+        except AttributeError:
+            raise StandardError('No such command %s' % args.action)
+        return cmd(args)
+
+
+def main():
+    cmd, args = script_helper.init_arguments(BarkerBench)
+    return cmd.run(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,18 +1,39 @@
 #!/usr/bin/python2.6
-from eventlet.queue import LifoQueue as Queue
+from eventlet.queue import Empty
 import eventlet
-eventlet.monkey_patch()
+import eventlet.semaphore
+from eventlet import tpool
+# MySQLdb is a C extension which blocks the whole process on every
+# query; patching it runs each call on eventlet's thread pool, so
+# workers' transactions actually overlap.
+eventlet.monkey_patch(all=True, MySQLdb=True)
 
 from clusto import script_helper
 from sgext.drivers import SGServer, EC2Zone
 from clusto.drivers import Pool
+from clusto.schema import ATTR_TABLE, ENTITY_TABLE
 from clusto.services.config import conf, get_logger
 import clusto
 import sgext
+from sgext.util import SGException
+from sgext.util.cache import LRUCache
+from sgext.util.coalesce import CoalescingQueue
+from sgext.util.connections import retry, size_pool
+from sgext.util.effective import EffectiveAttrs
+from sgext.util.query import is_member, live
+from sgext.util.spool import Spool
+from sgext.util.stats_server import serve_stats
 
 import kombu
+from sqlalchemy import and_, case, select
+from ostrich import stats
 
 from traceback import format_exc
+import errno
+import hashlib
+import json
+import socket
+import zlib
 from time import sleep, time
 import logging
 import sys
@@ -34,45 +55,180 @@ EC2_SUBKEYS = {
 
 log = get_logger('clusto.barker', level='DEBUG')
 
-def barker_callback(body):
-    if not 'ec2' in body:
-        return
-    if not 'instance-id' in body['ec2']:
-        return
+def desired_attrs(body):
+    """
+    Return the attributes a barker message says the server should have.
+
+    The result is a tuple of (desired, exclusive). desired maps
+    (key, subkey, number) to a value. exclusive is a set of (key, subkey)
+    scopes owned entirely by barker; existing attributes in those scopes
+    which are not in desired are deleted. A subkey of None in exclusive
+    covers the whole key.
+    """
+    ec2 = body['ec2']
+    system = body['os']
+    desired = {}
+    exclusive = set([('ec2', 'security-group'), ('disk', None)])
+
+    desired[('ec2', 'instance-id', None)] = ec2['instance-id']
+    for key, subkey in EC2_SUBKEYS.items():
+        desired[('ec2', subkey, None)] = ec2[key]
+
+    for i, group in enumerate(sorted(ec2['security-groups'])):
+        desired[('ec2', 'security-group', i)] = group
+
+    desired[('system', 'memory', None)] = int(system['memory']['MemTotal']) / 1024
+    desired[('system', 'hostname', None)] = system['hostname']
+    desired[('system', 'os', None)] = system['operatingsystemrelease']
+    if 'cpu' in system and len(system['cpu']) > 0:
+        desired[('system', 'cputype', None)] = system['cpu'][0]['model name']
+        desired[('system', 'cpucount', None)] = len(system['cpu'])
+        desired[('system', 'cpucache', None)] = system['cpu'][0]['cache size']
+    if 'kernelrelease' in system:
+        desired[('system', 'kernelrelease', None)] = system['kernelrelease']
+
+    blockmap = [(v.replace('/dev/', ''), k) for k, v in ec2['block-device-mapping'].items() if k != 'root']
+    blockmap = dict(blockmap)
+    total_disk = 0
+    for i, disk in enumerate(system['disks']):
+        for subkey in disk.keys():
+            desired[('disk', subkey, i)] = str(disk[subkey])
+        if disk['osname'] in blockmap:
+            desired[('disk', 'ec2-type', i)] = blockmap[disk['osname']]
+        total_disk += disk['size']
+    desired[('system', 'disk', None)] = total_disk / 1073741824
+
+    for subkey, value in body.get('sgmetadata', {}).items():
+        desired[('sgmetadata', subkey, None)] = value
+
+    for owner, reason in body.get('owners', {}).iteritems():
+        desired[('owner', owner, None)] = reason
+
+    return desired, exclusive
+
+
+def reconcile_attrs(server, desired, exclusive=()):
+    """
+    Bring server's attributes in line with desired, touching only the
+    attributes which differ.
+
+    The server's current attributes are loaded once, and only the
+    inserts and deletes needed to reach the desired state are issued.
+    Returns the list of (key, subkey, number) tuples that were changed.
+    """
+    current = {}
+    for attr in server.attrs():
+        current.setdefault((attr.key, attr.subkey, attr.number), []).append(attr)
+
+    changed = []
+    for (key, subkey, number), value in desired.items():
+        existing = current.get((key, subkey, number), [])
+        if len(existing) == 1 and existing[0].value == value:
+            continue
+        if existing:
+            server.del_attrs(key=key, subkey=subkey, number=number)
+        server.add_attr(key=key, subkey=subkey, number=number, value=value)
+        changed.append((key, subkey, number))
+
+    for (key, subkey, number) in current:
+        if (key, subkey, number) in desired:
+            continue
+        if (key, None) in exclusive or (key, subkey) in exclusive:
+            server.del_attrs(key=key, subkey=subkey, number=number)
+            changed.append((key, subkey, number))
+
+    return changed
+
+
+class EntityCache(object):
+
+    """
+    Cache of the zone and pool entities update_server resolves for
+    every message, and of the attributes servers inherit from them.
+
+    The set of zones and pools is small and rarely changes, so each
+    worker keeps the resolved entities, and the fact that their
+    pooltype has been set, for ttl seconds. Entities belong to the
+    worker's session, so the cache must be cleared whenever that
+    session's transaction is rolled back.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.entities = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.effective = EffectiveAttrs()
+
+    def clear(self):
+        self.entities.clear()
+        self.effective.clear()
+
+    def zone(self, name):
+        zone = self.entities.get(('zone', name))
+        if zone is None:
+            zone = clusto.get(name)
+            if not zone:
+                zone = EC2Zone(name)
+            else:
+                zone = zone[0]
+            self.entities[('zone', name)] = zone
+        return zone
+
+    def pool(self, name, pooltype):
+        pool = self.entities.get(('pool', name, pooltype))
+        if pool is None:
+            pool = clusto.get_or_create(name, Pool)
+            if not pool.attrs(key='pooltype', value=pooltype):
+                pool.set_attr(key='pooltype', value=pooltype)
+            self.entities[('pool', name, pooltype)] = pool
+        return pool
+
+
+def update_server(body, cache=None):
+    """
+    Apply a single barker message to clusto.
+
+    This does not manage transactions; callers are expected to wrap it
+    in clusto.begin_transaction()/clusto.commit().
+    """
+    cache = cache or EntityCache()
     ec2 = body['ec2']
+    sgmetadata = body.get('sgmetadata', {})
     log.debug(ec2['instance-id'])
 
-    try:
-        clusto.begin_transaction()
+    with stats.time('barker_stage_entity_lookup'):
         server = clusto.get_or_create(ec2['instance-id'], SGServer)
+        pools = [cache.zone(ec2['placement'])]
 
-        if not server.attr_values(key='ec2', subkey='instance-id'):
-            server.set_attr(key='ec2', subkey='instance-id', value=ec2['instance-id'])
-
-        zone = clusto.get(ec2['placement'])
-        if not zone:
-            zone = EC2Zone(ec2['placement'])
-        else:
-            zone = zone[0]
-        if not server in zone:
-            zone.insert(server)
-
-        for key, subkey in EC2_SUBKEYS.items():
-            server.set_attr(key='ec2', subkey=subkey, value=ec2[key])
-
-        previous_ec2sg = server.attr_values(key='ec2',subkey='security-group')
-        for group in set(previous_ec2sg).difference(set(ec2['security-groups'])):
-            server.del_attrs(key='ec2',subkey='security-group', value=group)
-
-        for i,group in enumerate(sorted(ec2['security-groups'])):
-            server.set_attr(key='ec2', subkey='security-group', number=i, value=group)
+        for group in ec2['security-groups']:
             if group.find('_') != -1:
                 environment, role = group.lower().split('_', 1)
-                p = clusto.get_or_create(environment, Pool)
-                if not p.attrs(key='pooltype', value='environment'):
-                    p.set_attr(key='pooltype', value='environment')
-                if not server in p:
-                    p.insert(server)
+                pools.append(cache.pool(environment, 'environment'))
+
+        for subkey, pooltype in (('clusterid', 'clusterid'), ('role', 'role')):
+            value = sgmetadata.get(subkey)
+            if value:
+                pools.append(cache.pool(value, pooltype))
+
+    membership = []
+    with stats.time('barker_stage_pool_inserts'):
+        for p in pools:
+            if not is_member(p, server):
+                p.insert(server)
+                membership.append(('parents', p.name, None))
+
+    with stats.time('barker_stage_attr_writes'):
+        desired, exclusive = desired_attrs(body)
+
+        classes = [row for row in cache.effective.attrs(server.entity.entity_id)
+                   if row.key == 'puppet' and row.subkey == 'class']
+        if not classes:
+            if sgmetadata.get('role'):
+                value = 'site::role::%s' % sgmetadata['role']
+            else:
+                log.warning('Found host %s with no role set, using site::role::base' % ec2['instance-id'])
+                value = 'site::role::base'
+            desired[('puppet', 'class', None)] = value
+
+        changed = reconcile_attrs(server, desired, exclusive)
 
         #server.bind_ip_to_osport(ec2['local-ipv4'], 'nic-eth', 0)
         #server.bind_ip_to_osport(ec2['public-ipv4'], 'nic-eth', 0)
@@ -80,132 +236,682 @@ def barker_callback(body):
             server.del_attrs(key='ip', subkey='ipstring')
             server.add_attr(key='ip', subkey='ipstring', value=ec2['local-ipv4'], number=0)
             server.add_attr(key='ip', subkey='ipstring', value=ec2['public-ipv4'], number=0)
+            changed.append(('ip', 'ipstring', 0))
+
+    stats.incr('barker_attrs_changed', len(changed))
+    changed.extend(membership)
+
+    log.debug('%s: %d attributes changed' % (ec2['instance-id'], len(changed)))
+    return changed
+
 
-        system = body['os']
-        server.set_attr(key='system', subkey='memory',
-                        value=int(system['memory']['MemTotal']) / 1024)
-        server.set_attr(key='system', subkey='hostname',
-                        value=system['hostname'])
-        server.set_attr(key='system', subkey='os',
-                        value=system['operatingsystemrelease'])
-        if 'cpu' in system and len(system['cpu']) > 0:
-            server.set_attr(key='system', subkey='cputype',
-                            value=system['cpu'][0]['model name'])
-            server.set_attr(key='system', subkey='cpucount',
-                            value=len(system['cpu']))
-            server.set_attr(key='system', subkey='cpucache',
-                            value=system['cpu'][0]['cache size'])
-
-        if 'kernelrelease' in system:
-            server.set_attr(key='system', subkey='kernelrelease',
-                            value=system['kernelrelease'])
-
-        previous_disk = server.attr_key_tuples(key='disk')
-        incoming_disk = []
-        blockmap = [(v.replace('/dev/', ''), k) for k, v in ec2['block-device-mapping'].items() if k != 'root']
-        blockmap = dict(blockmap)
-        total_disk = 0
-        for i, disk in enumerate(system['disks']):
-            for subkey in disk.keys():
-                server.set_attr(key='disk', subkey=subkey, number=i, value=str(disk[subkey]))
-                incoming_disk.append(('disk',i,subkey))
-            if disk['osname'] in blockmap:
-                server.set_attr(key='disk', subkey='ec2-type', number=i, value=blockmap[disk['osname']])
-                incoming_disk.append(('disk',i,'ec2-type'))
-            total_disk += disk['size']
-        total_disk = total_disk / 1073741824
-        server.set_attr(key='system', subkey='disk', value=total_disk)
-
-        for attr in set(previous_disk).difference(set(incoming_disk)):
-            server.del_attrs(key=attr[0],subkey=attr[2],number=attr[1])
-
-        for subkey, value in body.get('sgmetadata', {}).items():
-            server.set_attr(key='sgmetadata', subkey=subkey, value=value)
-            if subkey == 'clusterid' and value:
-                cluster = clusto.get_or_create(value, Pool)
-                if not cluster.attrs(key='pooltype', value='clusterid'):
-                    cluster.set_attr(key='pooltype', value='clusterid')
-                if not server in cluster:
-                    cluster.insert(server)
-            if subkey == 'role' and value:
-                if len(server.attr_values(key='puppet', subkey='class', merge_container_attrs=True)) == 0:
-                    server.set_attr(key='puppet', subkey='class',
-                                    value='site::role::%s' % value)
-
-                p = clusto.get_or_create(value, Pool)
-                if not p.attrs(key='pooltype', value='role'):
-                    p.set_attr(key='pooltype', value='role')
-                if not server in p:
-                    p.insert(server)
-
-        if len(server.attr_values(key='puppet', subkey='class', merge_container_attrs=True)) == 0:
-            log.warning('Found host %s with no role set, using site::role::base' % ec2['instance-id'])
-            server.set_attr(key='puppet', subkey='class',
-                            value='site::role::base')
-
-        #server.set_attr(key='barker', subkey='last_updated', value=int(time()))
+def valid_message(body):
+    return 'ec2' in body and 'instance-id' in body['ec2']
 
+
+def message_digest(body):
+    """
+    Return a stable hash of the parts of a barker message that
+    update_server actually reads, ignoring volatile fields.
+    """
+    ec2 = body['ec2']
+    system = body.get('os', {})
+    cpu = system.get('cpu') or []
+    consumed = {
+        'ec2': dict((k, ec2.get(k)) for k in
+                    ['instance-id', 'placement', 'security-groups',
+                     'block-device-mapping', 'local-ipv4', 'public-ipv4'] +
+                    EC2_SUBKEYS.keys()),
+        'os': {
+            'memory': system.get('memory', {}).get('MemTotal'),
+            'hostname': system.get('hostname'),
+            'operatingsystemrelease': system.get('operatingsystemrelease'),
+            'kernelrelease': system.get('kernelrelease'),
+            'cpu': cpu and [len(cpu), cpu[0].get('model name'), cpu[0].get('cache size')],
+            'disks': system.get('disks'),
+        },
+        'sgmetadata': body.get('sgmetadata', {}),
+        'owners': body.get('owners', {}),
+    }
+    return hashlib.sha1(json.dumps(consumed, sort_keys=True)).hexdigest()
+
+
+class ChangeFeed(object):
+
+    """
+    Publishes a compact event whenever barker changes a server.
+
+    Events are JSON objects with the server name, the sorted list of
+    changed keys ('key.subkey', or 'parents' for pool membership) and a
+    version number. Versions start at the process start time in
+    milliseconds and increase by one per event, so they keep increasing
+    across restarts. Subclasses implement send(); publishing errors are
+    logged and never affect the consumer.
+    """
+
+    def __init__(self):
+        self.version = int(time() * 1000)
+        self.lock = eventlet.semaphore.Semaphore()
+
+    def publish(self, name, changed):
+        if not changed:
+            return
+        keys = set()
+        for key, subkey, number in changed:
+            if key == 'parents':
+                keys.add('parents')
+            elif subkey is not None:
+                keys.add('%s.%s' % (key, subkey))
+            else:
+                keys.add(key)
+        with self.lock:
+            self.version += 1
+            event = {'name': name, 'changed': sorted(keys),
+                     'version': self.version}
+            try:
+                self.send(json.dumps(event, separators=(',', ':')))
+                stats.incr('barker_changes_published')
+            except Exception:
+                log.warning('Unable to publish change for %s: %s' % (name, format_exc()))
+                stats.incr('barker_changes_failed')
+
+    def send(self, data):
+        raise NotImplementedError
+
+
+class AMQPChangeFeed(ChangeFeed):
+
+    """Publishes change events to a fanout exchange."""
+
+    def __init__(self, hostname, exchange):
+        ChangeFeed.__init__(self)
+        self.connection = kombu.BrokerConnection(
+            hostname=hostname,
+            userid=QUEUE_USER,
+            password=QUEUE_PASSWORD,
+            virtual_host=QUEUE_VHOST)
+        self.exchange = kombu.Exchange(exchange, type='fanout',
+                                       delivery_mode='transient')
+        self.producer = None
+
+    def send(self, data):
+        if self.producer is None:
+            self.producer = kombu.Producer(self.connection.channel(),
+                                           exchange=self.exchange)
         try:
-            owners = body['owners']
-            for owner, reason in owners.iteritems():
-                server.set_attr(key='owner', subkey=owner, value=reason)
-        except KeyError:
-            pass
+            self.producer.publish(data, content_type='application/json',
+                                  content_encoding='utf-8')
+        except Exception:
+            self.producer = None
+            raise
+
+
+class UnixChangeFeed(ChangeFeed):
+
+    """
+    Sends change events as datagrams to a Unix socket. Events are
+    silently dropped while nothing is listening.
+    """
+
+    def __init__(self, path):
+        ChangeFeed.__init__(self)
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def send(self, data):
+        try:
+            self.sock.sendto(data, self.path)
+        except socket.error, e:
+            if e.args[0] not in (errno.ENOENT, errno.ECONNREFUSED):
+                raise
+
 
-        clusto.commit()
+def barker_callback(body, cache=None, feed=None):
+    if not valid_message(body):
+        return
+
+    try:
+        clusto.begin_transaction()
+        changed = update_server(body, cache)
+        with stats.time('barker_stage_commit'):
+            clusto.commit()
+        if feed:
+            feed.publish(body['ec2']['instance-id'], changed)
+        return True
     except:
-        log.warning('Exception from %s: %s' % (ec2['instance-id'], format_exc()))
+        log.warning('Exception from %s: %s' % (body['ec2']['instance-id'], format_exc()))
         clusto.rollback_transaction()
+        stats.incr('barker_rollbacks')
+        if cache:
+            cache.clear()
+        return False
+
+
+def barker_batch(bodies, cache=None, feed=None):
+    """
+    Apply several barker messages in a single transaction.
+
+    If anything in the batch fails, the batch is rolled back and every
+    message is retried in its own transaction, so one bad payload can't
+    keep the rest from being applied. Returns the list of messages which
+    were committed.
+    """
+    bodies = filter(valid_message, bodies)
+    if not bodies:
+        return []
+    if len(bodies) == 1:
+        return [body for body in bodies if barker_callback(body, cache, feed)]
+
+    start = time()
+    try:
+        clusto.begin_transaction()
+        changes = [(body['ec2']['instance-id'], update_server(body, cache))
+                   for body in bodies]
+        with stats.time('barker_stage_commit'):
+            clusto.commit()
+    except:
+        log.warning('Batch of %d failed, falling back to per-message commits: %s' % (len(bodies), format_exc()))
+        clusto.rollback_transaction()
+        stats.incr('barker_rollbacks')
+        if cache:
+            cache.clear()
+        stats.incr('barker_batch_fallbacks')
+        stats.incr('barker_batch_fallback_messages', len(bodies))
+        return [body for body in bodies if barker_callback(body, cache, feed)]
+    stats.add_timing('barker_batch_commit', int((time() - start) * 1000))
+    if feed:
+        for name, changed in changes:
+            feed.publish(name, changed)
+    return bodies
+
+
+def database_alive():
+    """Return True if the clusto database answers a trivial query."""
+    try:
+        clusto.SESSION.execute('SELECT 1')
+        return True
+    except Exception:
+        return False
+
+
+def flush_last_seen(seen, chunk=1000):
+    """
+    Write barker last_updated timestamps for many servers at once.
+
+    seen maps server names to unix timestamps. Servers which already
+    have the attribute are updated with a single UPDATE per chunk. The
+    session never sees that change, so clusto.commit() would find
+    nothing to commit and roll it back; each UPDATE is committed in its
+    own transaction instead, and checked to have updated every row it
+    should have. Servers seeing the attribute for the first time then
+    get it added through the driver; callers manage that transaction.
+    """
+    names = seen.keys()
+    missing = []
+    for i in range(0, len(names), chunk):
+        with clusto.SESSION.bind.begin() as connection:
+            rows = connection.execute(
+                select([ENTITY_TABLE.c.entity_id, ENTITY_TABLE.c.name],
+                       and_(ENTITY_TABLE.c.name.in_(names[i:i + chunk]),
+                            live(ENTITY_TABLE)))).fetchall()
+            timestamps = dict((row[0], seen[row[1]]) for row in rows)
+            if not timestamps:
+                continue
+
+            match = and_(ATTR_TABLE.c.entity_id.in_(timestamps.keys()),
+                         ATTR_TABLE.c.key == 'barker',
+                         ATTR_TABLE.c.subkey == 'last_updated',
+                         live(ATTR_TABLE))
+            existing = set(row[0] for row in connection.execute(
+                select([ATTR_TABLE.c.entity_id], match)))
+            if existing:
+                result = connection.execute(
+                    ATTR_TABLE.update()
+                    .where(and_(match, ATTR_TABLE.c.entity_id.in_(existing)))
+                    .values(int_value=case(
+                        dict((entity_id, timestamps[entity_id]) for entity_id in existing),
+                        value=ATTR_TABLE.c.entity_id)))
+                if result.rowcount != len(existing):
+                    raise SGException('Updated %d of %d last_updated attributes'
+                                      % (result.rowcount, len(existing)))
+
+        missing.extend(name for entity_id, name in rows if entity_id not in existing)
+        stats.incr('barker_last_seen_flushed', len(timestamps))
+
+    for name in missing:
+        clusto.get_by_name(name).add_attr(key='barker', subkey='last_updated',
+                                          value=seen[name])
+
+
+@retry(max_=3, delay=1, exceptions=(socket.error, IOError),
+       name='barker_broker_connect')
+def broker_connection(hostname):
+    """
+    Connect to the broker on hostname, retrying brief network blips
+    before giving up.
+    """
+    connection = kombu.BrokerConnection(
+        hostname=hostname,
+        userid=QUEUE_USER,
+        password=QUEUE_PASSWORD,
+        virtual_host=QUEUE_VHOST)
+    connection.connect()
+    return connection
+
 
 class BarkerConsumer(clusto.script_helper.Script):
     def __init__(self):
         clusto.script_helper.Script.__init__(self)
-        self.queue = None
+        self.queues = []
+        self.digests = None
+        self.ack = False
+        self.prefetch = None
+        self.brokers = {}
+        self.last_seen = None
+        self.spool = None
+        self.feed = None
+        self.spool_threshold = None
+        self.db_down = False
+        self.drain_timeout = None
+        self.idle_timeout = None
+        self.reconnect_delay = None
+        self.reconnect_limit = None
+
+    def shard(self, instance_id):
+        """Return the queue which owns updates for instance_id."""
+        return self.queues[zlib.crc32(instance_id) % len(self.queues)]
+
+    def qsize(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def settle(self, message, committed, requeue=False):
+        """
+        In acked mode, acknowledge message once its state is in clusto.
+        A message which could not be applied is requeued if requeue is
+        set, and otherwise rejected.
+
+        Messages which arrived on a connection that has since been
+        closed can't be settled, and the broker redelivers them anyway.
+        """
+        if not self.ack or message is None:
+            return
+        try:
+            if committed:
+                message.ack()
+            elif requeue:
+                message.requeue()
+            else:
+                message.reject()
+        except Exception, e:
+            log.debug('Unable to settle message: %s' % e)
+            stats.incr('barker_settle_failures')
 
     def callback(self, body, message):
-        if self.queue.qsize() > 500:
-            log.warning('Dropping message, queue size is over 500')
+        if not valid_message(body):
+            stats.incr('barker_dropped_invalid')
+            self.settle(message, True)
             return
-        self.queue.put(body)
+        stats.incr('barker_received')
+        # Once anything is spooled, everything is spooled until the
+        # spool drains, so older spooled state never overwrites newer.
+        if self.spool is not None and (len(self.spool) or
+                                       self.qsize() >= self.spool_threshold):
+            self.spool.append(body)
+            stats.incr('barker_spooled')
+            self.settle(message, True)
+            return
+        self.enqueue(body, message)
+
+    def enqueue(self, body, message):
+        instance_id = body['ec2']['instance-id']
+        replaced = self.shard(instance_id).put(instance_id, (time(), body, message))
+        if replaced:
+            # The newer message supersedes this one, so it is done with.
+            self.settle(replaced[2], True)
+
+    def spool_drainer(self):
+        """
+        Move spooled messages back onto the queue, oldest segment
+        first, whenever the queue is below half the spool threshold.
+        Each segment is coalesced per instance, so catching up only
+        applies the latest state of each server.
+
+        While the DB is down nothing is moved; the drainer checks every
+        second whether it is back.
+        """
+        while True:
+            eventlet.sleep(1)
+            if self.db_down:
+                if not database_alive():
+                    continue
+                self.db_down = False
+            while (len(self.spool) and not self.db_down and
+                   self.qsize() < self.spool_threshold / 2):
+                latest = {}
+                for body in self.spool.pop_segment():
+                    latest[body['ec2']['instance-id']] = body
+                for body in latest.values():
+                    self.enqueue(body, None)
+                stats.incr('barker_unspooled', len(latest))
+
+    def unchanged(self, body):
+        """
+        Return True if body matches the last committed message for its
+        instance.
+        """
+        digest = self.digests.get(body['ec2']['instance-id'])
+        return digest is not None and digest == message_digest(body)
+
+    def next_batch(self, queue, size, interval):
+        """
+        Block for a message, then collect up to size messages or
+        whatever arrives within interval seconds, whichever is first.
+        """
+        batch = [queue.get()]
+        deadline = time() + interval
+        while len(batch) < size:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(queue.get(timeout=remaining))
+            except Empty:
+                break
+
+        now = time()
+        for enqueued, body, message in batch:
+            stats.add_timing('barker_stage_queue_wait', int((now - enqueued) * 1000))
+        return [(body, message) for enqueued, body, message in batch]
 
     def run(self, args):
-        self.queue = Queue()
+        # One connection for each worker, one for the last seen flusher,
+        # which uses one at a time, and one for the spool drainer's
+        # checks that the DB is back.
+        size_pool(args.workers + 2)
+        tpool.set_num_threads(args.workers + 2)
+        self.ack = args.ack
+        self.prefetch = args.prefetch
+        self.drain_timeout = args.drain_timeout
+        self.idle_timeout = args.idle_timeout
+        self.reconnect_delay = args.reconnect_delay
+        self.reconnect_limit = args.reconnect_limit
+        self.queues = [CoalescingQueue() for i in range(args.workers)]
+        self.digests = LRUCache(maxsize=args.dedupe_size,
+                                ttl=args.dedupe_refresh)
+
+        stats.make_gauge('barker_queue_size', self.qsize)
+        stats.make_gauge('barker_queue_replaced',
+                         lambda: sum(q.replaced for q in self.queues))
+        for i, queue in enumerate(self.queues):
+            stats.make_gauge('barker_queue_size_%d' % i, queue.qsize)
+        if args.stats_port:
+            serve_stats(args.stats_port)
+
         for hostname in QUEUE_HOSTS:
             eventlet.spawn_n(self.consumer, hostname)
 
+        if args.changes_exchange:
+            self.feed = AMQPChangeFeed(QUEUE_HOSTS[0], args.changes_exchange)
+        elif args.changes_socket:
+            self.feed = UnixChangeFeed(args.changes_socket)
+
+        if args.spool_dir:
+            self.spool = Spool(args.spool_dir,
+                               segment_size=args.spool_segment_size * 1024 * 1024,
+                               use_mmap=args.spool_mmap)
+            self.spool_threshold = args.spool_threshold
+            stats.make_gauge('barker_spool_segments', lambda: len(self.spool))
+            eventlet.spawn_n(self.spool_drainer)
+
+        if args.last_seen_interval:
+            self.last_seen = {}
+            eventlet.spawn_n(self.last_seen_flusher, args.last_seen_interval)
+
+        pool = eventlet.GreenPool(args.workers)
+        for queue in self.queues:
+            pool.spawn_n(self.worker, queue, args)
+        pool.waitall()
+
+    def worker(self, queue, args):
+        """
+        Apply messages from one shard of the queue.
+
+        Each worker runs in its own greenthread, and clusto's scoped
+        session is greenthread-local once eventlet has monkey-patched
+        threading, so every worker gets its own session and DB
+        connection. MySQLdb calls run on eventlet's thread pool, so
+        one worker waiting on the DB doesn't hold up the others. An
+        unexpected error is logged and the worker moves on to the next
+        batch, so its shard keeps draining.
+        """
+        interval = args.batch_interval / 1000.0
+        cache = EntityCache(ttl=args.cache_ttl)
         while True:
-            body = self.queue.get()
-            log.debug('Queue size %s' % self.queue.qsize())
-            barker_callback(body)
+            try:
+                self.apply_batch(queue, args, interval, cache)
+            except Exception:
+                log.error('Worker failed: %s' % format_exc())
+                stats.incr('barker_worker_errors')
+                eventlet.sleep(1)
+
+    def apply_batch(self, queue, args, interval, cache):
+        """Apply the next batch of messages from queue."""
+        start = time()
+        batch = self.next_batch(queue, args.batch_size, interval)
+        log.debug('Queue size %s' % self.qsize())
+        stats.add_timing('barker_batch_size', len(batch))
+        stats.add_timing('barker_batch_flush_interval', int((time() - start) * 1000))
+        fresh = []
+        for body, message in batch:
+            if self.unchanged(body):
+                stats.incr('barker_dedupe_skipped')
+                self.seen(body)
+                self.settle(message, True)
+            else:
+                fresh.append((body, message))
+
+        committed = barker_batch([body for body, message in fresh], cache, self.feed)
+        committed = set(id(body) for body in committed)
+        if fresh and not committed and not database_alive():
+            # The DB is unavailable, so the messages aren't at fault;
+            # keep them, on disk or on the broker, and give the DB a
+            # moment. Messages which failed while the DB was up were
+            # already retried one at a time, and are rejected below.
+            self.db_down = True
+            if self.spool is not None:
+                self.respool(fresh)
+            else:
+                for body, message in fresh:
+                    self.settle(message, False, requeue=True)
+            eventlet.sleep(1)
+            return
+        if committed:
+            self.db_down = False
+        for body, message in fresh:
+            if id(body) in committed:
+                self.digests[body['ec2']['instance-id']] = message_digest(body)
+                self.seen(body)
+            self.settle(message, id(body) in committed)
+
+    def respool(self, batch):
+        """Spool messages which couldn't be applied while the DB was down."""
+        for body, message in batch:
+            self.spool.append(body)
+            stats.incr('barker_spooled')
+            self.settle(message, True)
+
+    def seen(self, body):
+        """Note that body's instance was just heard from."""
+        if self.last_seen is not None:
+            self.last_seen[body['ec2']['instance-id']] = int(time())
+
+    def last_seen_flusher(self, interval):
+        """
+        Every interval seconds, write the last time each server was
+        heard from to its barker last_updated attribute in bulk. On
+        failure the timestamps are kept for the next flush.
+
+        This is off unless --last-seen-interval is set. last_updated is
+        an attribute like any other, so each flush changes the ENC
+        fingerprints and chef ETags of every server it touches, and
+        their cached documents are rebuilt and re-sent on the next
+        poll. Pick an interval no shorter than those caches are worth.
+        """
+        while True:
+            eventlet.sleep(interval)
+            seen, self.last_seen = self.last_seen, {}
+            if not seen:
+                continue
+            try:
+                clusto.begin_transaction()
+                flush_last_seen(seen)
+                clusto.commit()
+            except:
+                log.warning('Unable to flush last seen times: %s' % format_exc())
+                clusto.rollback_transaction()
+                for name, timestamp in seen.items():
+                    if timestamp > self.last_seen.get(name, 0):
+                        self.last_seen[name] = timestamp
+
+    def _add_arguments(self, parser):
+        parser.add_argument('--changes-exchange', default=None,
+                            help='Publish attribute change events to this fanout exchange')
+        parser.add_argument('--changes-socket', default=None,
+                            help='Send attribute change events to this Unix datagram socket')
+        parser.add_argument('--spool-dir', default=None,
+                            help='Spool overflow messages to this directory')
+        parser.add_argument('--spool-threshold', type=int, default=5000,
+                            help='Queued messages above which new messages are spooled')
+        parser.add_argument('--spool-segment-size', type=int, default=16,
+                            help='Size of each spool segment in MB')
+        parser.add_argument('--spool-mmap', action='store_true', default=False,
+                            help='Read spool segments back with mmap')
+        parser.add_argument('--last-seen-interval', type=int, default=0,
+                            help='Seconds between bulk writes of barker last_updated; '
+                                 'each write invalidates ENC and chef caches for the '
+                                 'servers it touches (default 0, disabled)')
+        parser.add_argument('--drain-timeout', type=int, default=5,
+                            help='Seconds to wait for a message before checking the connection')
+        parser.add_argument('--idle-timeout', type=int, default=120,
+                            help='Seconds without a message after which a broker '
+                                 'connection is assumed dead and reopened')
+        parser.add_argument('--reconnect-delay', type=int, default=1,
+                            help='Initial seconds to wait before reconnecting to a broker')
+        parser.add_argument('--reconnect-limit', type=int, default=60,
+                            help='Maximum seconds to wait before reconnecting to a broker')
+        parser.add_argument('--ack', action='store_true', default=False,
+                            help='Acknowledge messages only after they are committed')
+        parser.add_argument('--prefetch', type=int, default=100,
+                            help='Unacknowledged messages to hold per broker in --ack mode')
+        parser.add_argument('--stats-port', type=int, default=None,
+                            help='Serve ostrich stats as JSON on this port')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of DB workers; messages are sharded by instance-id')
+        parser.add_argument('--batch-size', type=int, default=1,
+                            help='Apply up to this many messages per transaction')
+        parser.add_argument('--batch-interval', type=int, default=100,
+                            help='Milliseconds to wait for a batch to fill')
+        parser.add_argument('--dedupe-size', type=int, default=100000,
+                            help='Number of instances to remember message hashes for')
+        parser.add_argument('--dedupe-refresh', type=int, default=900,
+                            help='Seconds after which an unchanged message is applied anyway')
+        parser.add_argument('--cache-ttl', type=int, default=300,
+                            help='Seconds to cache zone and pool lookups')
+
+    def add_subparser(self, subparsers):
+        parser = self._setup_subparser(subparsers)
+        self._add_arguments(parser)
+
+    def connect(self, hostname):
+        """
+        Connect to the broker on hostname and start consuming.
+        """
+        connection = broker_connection(hostname)
 
-    def consumer(self, hostname):
         exchange = kombu.Exchange(QUEUE_EXCHANGE, type='fanout',
                                   delivery_mode='transient')
         queue = kombu.Queue(QUEUE_NAME, exchange)
-        try:
-            connection = kombu.BrokerConnection(
-                hostname=hostname,
-                userid=QUEUE_USER,
-                password=QUEUE_PASSWORD,
-                virtual_host=QUEUE_VHOST)
-            channel = connection.channel()
-            consumer = kombu.Consumer(channel, queue,
-                                      callbacks=[self.callback],
-                                      no_ack=True)
-            consumer.consume()
-
-            log.info('%s consumer running' % hostname)
-            while True:
-                try:
-                    connection.drain_events()
-                except Exception, e:
-                    log.error(str(e))
-        except Exception, e:
-            log.error(format_exc())
-            raise e
-        finally:
-            if connection:
-                connection.release()
+        health = self.brokers[hostname]
+
+        def callback(body, message):
+            health['messages'] += 1
+            health['last_message'] = time()
+            # Timed here rather than around drain_events, which mostly
+            # waits for the next delivery.
+            with stats.time('barker_stage_amqp_deliver'):
+                self.callback(body, message)
+
+        channel = connection.channel()
+        consumer = kombu.Consumer(channel, queue,
+                                  callbacks=[callback],
+                                  no_ack=not self.ack)
+        if self.ack:
+            # The broker stops delivering once prefetch messages are
+            # unacknowledged, so a slow DB backs up on the broker
+            # rather than in this process.
+            consumer.qos(prefetch_count=self.prefetch)
+        consumer.consume()
+        return connection
+
+    def consumer(self, hostname):
+        """
+        Consume from one broker forever.
+
+        Every server reports to barker regularly, so a connection which
+        has delivered nothing for idle_timeout seconds is assumed dead
+        and reopened; drains time out so this is checked even when
+        nothing arrives. A failed connection is retried with an
+        exponentially increasing delay instead of spinning. After every
+        drain the greenthread yields, so each broker gets a turn and one
+        busy broker can't starve the others.
+        """
+        health = self.brokers[hostname] = {
+            'up': False,
+            'failures': 0,
+            'messages': 0,
+            'last_message': None,
+            'last_error': None,
+        }
+        stats.make_gauge('barker_broker_%s_up' % hostname,
+                         lambda: int(health['up']))
+        stats.make_gauge('barker_broker_%s_failures' % hostname,
+                         lambda: health['failures'])
+
+        while True:
+            connection = None
+            try:
+                connection = self.connect(hostname)
+                health['up'] = True
+                health['failures'] = 0
+                connected = time()
+                log.info('%s consumer running' % hostname)
+                while True:
+                    try:
+                        connection.drain_events(timeout=self.drain_timeout)
+                    except socket.timeout:
+                        last = max(connected, health['last_message'])
+                        if time() - last > self.idle_timeout:
+                            raise IOError('No messages for %ds' % self.idle_timeout)
+                    eventlet.sleep(0)
+            except Exception, e:
+                health['up'] = False
+                health['failures'] += 1
+                health['last_error'] = str(e)
+                stats.incr('barker_broker_reconnects')
+                # Not connections.backoff: it scales its delay by how
+                # long the failing call took, so a connection refused
+                # in milliseconds would be retried almost at once.
+                delay = min(self.reconnect_delay * 2 ** (health['failures'] - 1),
+                            self.reconnect_limit)
+                log.error('%s consumer failed (%d in a row), reconnecting in %ds: %s'
+                          % (hostname, health['failures'], delay, format_exc()))
+                eventlet.sleep(delay)
+            finally:
+                if connection:
+                    try:
+                        connection.release()
+                    except Exception:
+                        pass
 
 def main():
     barker_consumer, args = script_helper.init_arguments(BarkerConsumer)
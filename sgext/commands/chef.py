@@ -4,33 +4,238 @@ import clusto
 
 import simplejson as json
 import bottle
+import eventlet
+import eventlet.wsgi
+from eventlet import tpool
+import hashlib
+from ostrich import stats
 import sys
 import os
+import time
+import zlib
+
+from sgext.util.cache import LRUCache
+from sgext.util.connections import size_pool
+from sgext.util.effective import EffectiveAttrs
+from sgext.util.query import (batches, contents_of, ids_of, merged_attrs_of,
+                              names_of, row_value)
+from sgext.util.stats_server import serve_stats
+
+EFFECTIVE_ATTRS = EffectiveAttrs()
+
+# Serialized attribute documents by ETag.
+BODIES = LRUCache(maxsize=4096)
+
+
+def attributes_etag(rows):
+    """
+    Return a strong ETag for the attributes in rows. Most attributes
+    are only ever deleted and re-added, but barker's last_updated is
+    updated in place, so values are hashed along with the ids.
+    """
+    return '"%s"' % hashlib.sha1(','.join(
+        repr((row.attr_id, row.int_value, row.string_value)) for row in rows)).hexdigest()
+
+
+def attributes_document(rows):
+    """Return the attributes in rows as a {key: {subkey: [values]}} dict."""
+    results = {}
+    for row in rows:
+        if not row.key in results:
+            results[row.key] = {}
+        if not row.subkey in results[row.key]:
+            results[row.key][row.subkey] = []
+        results[row.key][row.subkey].append(row_value(row))
+    return results
+
+
+def not_modified(etag):
+    """Return True if the request's If-None-Match matches etag."""
+    header = bottle.request.headers.get('If-None-Match')
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in tags or ('W/' + etag) in tags
 
 
 @bottle.get('/attributes/:name.json')
 def get_attributes(name):
     obj = clusto.get_by_name(name)
-    results = {}
-    for attr in obj.attrs(merge_container_attrs=True):
-        if not attr.key in results:
-            results[attr.key] = {}
-        if not attr.subkey in results[attr.key]:
-            results[attr.key][attr.subkey] = []
-        results[attr.key][attr.subkey].append(attr.value)
-    print results
+    rows = EFFECTIVE_ATTRS.attrs(obj.entity.entity_id)
+    etag = attributes_etag(rows)
+    bottle.response.set_header('ETag', etag)
+    if not_modified(etag):
+        bottle.response.status = 304
+        return ''
 
     bottle.response.content_type = 'application/json'
-    return json.dumps(results, indent=2, sort_keys=True)
+    body = BODIES.get(etag)
+    if body is None:
+        body = BODIES[etag] = json.dumps(attributes_document(rows), indent=2, sort_keys=True)
+    return body
+
+
+def bulk_lines(names):
+    """
+    Yield a line of JSON with the attributes of each of names, loading
+    them 500 at a time.
+    """
+    for batch in batches(names):
+        ids = ids_of(batch)
+        attrs = merged_attrs_of(ids.values())
+        for name in batch:
+            if name in ids:
+                line = {'name': name, 'attributes': attributes_document(attrs[ids[name]])}
+            else:
+                line = {'name': name, 'error': 'not found'}
+            yield json.dumps(line, sort_keys=True) + '\n'
+
+
+def gzipped(lines):
+    """Yield lines compressed as a gzip stream."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for line in lines:
+        data = compressor.compress(line)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@bottle.get('/attributes')
+def get_bulk_attributes():
+    """
+    Stream the attributes of several entities as newline-delimited
+    JSON. Takes any number of name=NAME parameters, or pool=NAME for
+    everything in a pool. Compressed if the client accepts gzip.
+    """
+    if bottle.request.GET.get('pool'):
+        try:
+            pool = clusto.get_by_name(bottle.request.GET['pool'])
+        except LookupError:
+            bottle.abort(404, 'No such pool')
+        members = contents_of([pool.entity.entity_id], search_children=True)
+        names = sorted(set(names_of(members).values()))
+    else:
+        names = bottle.request.GET.getall('name')
+
+    bottle.response.content_type = 'application/x-ndjson'
+    lines = bulk_lines(names)
+    if 'gzip' in bottle.request.headers.get('Accept-Encoding', ''):
+        bottle.response.set_header('Content-Encoding', 'gzip')
+        bottle.response.set_header('Vary', 'Accept-Encoding')
+        lines = gzipped(lines)
+    return lines
+
+
+def in_thread(func, *args):
+    """
+    Call func in the calling pool thread, then release the thread's
+    clusto session so nothing loaded lingers into the next request.
+    """
+    try:
+        return func(*args)
+    finally:
+        clusto.SESSION.remove()
+
+
+class ThreadPoolApp(object):
+
+    """
+    WSGI middleware which runs app in eventlet's pool of OS threads, so
+    a request waiting on the database doesn't hold up the others.
+
+    clusto keeps one session per thread, and run() sizes the database
+    pool to match the thread pool, so every thread can hold a
+    connection and no more are opened. Any step of a request,
+    producing the response or each chunk of a streamed body, which
+    takes longer than timeout seconds is abandoned.
+    """
+
+    def __init__(self, app, timeout=30):
+        self.app = app
+        self.timeout = timeout
+        self.in_flight = 0
+        stats.make_gauge('chef_requests_in_flight', lambda: self.in_flight)
+
+    def __call__(self, environ, start_response):
+        self.in_flight += 1
+        stats.incr('chef_requests')
+        start = time.time()
+        # The app only records its response; it is started here, so an
+        # abandoned thread can't start it after a timeout has.
+        response = []
+
+        def record(status, headers, exc_info=None):
+            response[:] = [status, headers]
+
+        try:
+            with eventlet.Timeout(self.timeout):
+                body = tpool.execute(in_thread, self.app, environ, record)
+        except eventlet.Timeout:
+            self.finished(start)
+            stats.incr('chef_timeouts')
+            start_response('503 Service Unavailable', [('Content-Type', 'text/plain')])
+            return ['Timed out\n']
+        start_response(*response)
+        return self.stream(body, start)
+
+    def stream(self, body, start):
+        try:
+            chunks = iter(body)
+            while True:
+                with eventlet.Timeout(self.timeout):
+                    chunk = tpool.execute(in_thread, next, chunks, None)
+                if chunk is None:
+                    break
+                yield chunk
+        except eventlet.Timeout:
+            stats.incr('chef_timeouts')
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            self.finished(start)
+
+    def finished(self, start):
+        self.in_flight -= 1
+        stats.add_timing('chef_request', (time.time() - start) * 1000)
 
 
 class Chefd(script_helper.Script):
     def __init__(self):
         script_helper.Script.__init__(self)
 
+    def _add_arguments(self, parser):
+        parser.add_argument('--listen', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=9997)
+        parser.add_argument('--threads', type=int, default=20,
+                            help='Number of requests, and database connections, '
+                                 'handled at once')
+        parser.add_argument('--max-clients', type=int, default=1024,
+                            help='Number of client connections accepted at once')
+        parser.add_argument('--timeout', type=int, default=30,
+                            help='Seconds any step of a request may take')
+        parser.add_argument('--stats-port', type=int, default=None,
+                            help='Serve ostrich stats as JSON on this port')
+        parser.add_argument('--debug', action='store_true', default=False,
+                            help="Run on bottle's single-threaded debug server")
+
+    def add_subparser(self, subparsers):
+        parser = self._setup_subparser(subparsers)
+        self._add_arguments(parser)
+
     def run(self, args):
-        bottle.debug(True)
-        bottle.run(port=9997)
+        if args.debug:
+            bottle.debug(True)
+            bottle.run(host=args.listen, port=args.port)
+            return
+
+        if args.stats_port:
+            serve_stats(args.stats_port)
+        size_pool(args.threads)
+        tpool.set_num_threads(args.threads)
+        app = ThreadPoolApp(bottle.default_app(), timeout=args.timeout)
+        eventlet.wsgi.server(eventlet.listen((args.listen, args.port)), app,
+                             custom_pool=eventlet.GreenPool(args.max_clients))
 
 def main():
     cmd, args = script_helper.init_arguments(Chefd)
@@ -1,23 +1,66 @@
 #!/usr/bin/env python
 from clusto import script_helper
+from clusto.drivers import Pool
+from clusto.schema import ATTR_TABLE
 import clusto
+from sqlalchemy import and_, or_, select
 
 import sgext
 from sgext.drivers import EC2Zone
+from sgext.util.query import (batches, contents_of, live, names_of, parents_of,
+                              pool_intersection, row_value)
 
 import csv
 import sys
 
 class EC2Report(script_helper.Script):
+    def members(self, pools):
+        """
+        Return the names and ids of the entities in all of pools, in the
+        order clusto.get_from_pools(pools) would return them.
+        """
+        members = []
+        for pool in pools:
+            pool = clusto.get_by_name(pool, assert_driver=Pool)
+            found = contents_of([pool.entity.entity_id], search_children=True)
+            names = names_of(found)
+            members.append([(names[member], member) for member in found])
+        return pool_intersection(members)
+
+    def rows(self, members, keys):
+        """
+        Yield a report row for each of members, reading the zones and
+        attributes of 500 at a time.
+        """
+        pairs = [key.split('_', 1) for key in keys]
+        wanted = or_(*[and_(ATTR_TABLE.c.key == k, ATTR_TABLE.c.subkey == sk)
+                       for k, sk in pairs])
+        zone_names = {}
+        for batch in batches(members):
+            entity_ids = [entity_id for name, entity_id in batch]
+            zones = parents_of(entity_ids, clusto_types=[EC2Zone._clusto_type])
+            missing = set(zone for found in zones.values() for zone in found
+                          if zone not in zone_names)
+            zone_names.update(names_of(missing))
+
+            values = {}
+            query = select([ATTR_TABLE], and_(ATTR_TABLE.c.entity_id.in_(entity_ids),
+                                              wanted, live(ATTR_TABLE)))
+            for row in clusto.SESSION.execute(query.order_by(ATTR_TABLE.c.attr_id)):
+                values.setdefault((row.entity_id, row.key, row.subkey), []).append(row)
+
+            for name, entity_id in batch:
+                attrs = [name, zone_names[zones[entity_id][0]]]
+                for k, sk in pairs:
+                    attrs += [unicode(row_value(row)).strip()
+                              for row in values.get((entity_id, k, sk), [])]
+                yield attrs
+
     def run(self, args):
         keys = args.keys.split(",")
         writer = csv.writer(sys.stdout)
         writer.writerow(['name', 'zone'] + keys)
-        for entity in clusto.get_from_pools(args.pools):
-            attrs = [entity.name, entity.parents(clusto_types=[EC2Zone])[0].name]
-            for key in keys:
-                k, sk = key.split('_', 1)
-                attrs += [unicode(x).strip() for x in entity.attr_values(key=k, subkey=sk)]
+        for attrs in self.rows(self.members(args.pools), keys):
             writer.writerow(attrs)
 
     def _add_arguments(self, parser):
@@ -1,99 +1,577 @@
 #!/usr/bin/env python
 from clusto import script_helper
+from clusto.schema import ATTR_TABLE, ENTITY_TABLE
 import clusto
 import yaml
 import sys
+import os
+import time
+from multiprocessing import Pool as ProcessPool
+
+import eventlet
+import eventlet.wsgi
+from sqlalchemy import and_, distinct, func, select
+
+try:
+    from yaml import CDumper as Dumper
+except ImportError:
+    from yaml import Dumper
 
 import sgext
+from sgext.util.cache import LRUCache
+from sgext.util.effective import EffectiveAttrs
+from sgext.util.query import (ancestors_of, attr_fingerprint, batches,
+                              contents_of, entities_of, live,
+                              merged_attrs_of, names_of, parents_of,
+                              pool_intersection, resolve_hostname, row_value,
+                              string_values_of)
+
+# Peer maps by cluster entity_id, shared by every member of the cluster.
+PEER_MAPS = LRUCache(maxsize=256, ttl=300)
+
+EFFECTIVE_ATTRS = EffectiveAttrs()
+
+
+def render(result):
+    return yaml.dump(result, Dumper=Dumper, default_flow_style=False,
+                     explicit_start=True, indent=2)
+
+
+def write_file(path, data):
+    """Replace the file at path with data, atomically."""
+    tmp = '%s.%d' % (path, os.getpid())
+    fd = open(tmp, 'w')
+    try:
+        fd.write(data)
+    finally:
+        fd.close()
+    os.rename(tmp, path)
+
+
+def build(attrs, pools, peers, siblings):
+    """
+    Return the ENC document as a dict, or None if it would be empty.
+
+    attrs are the (key, subkey, value) of the server's attributes in
+    merge_container_attrs order, pools the names of its pools, peers
+    its cluster peers map and siblings the public DNS of its siblings.
+    """
+    result = {
+        'classes': [],
+        'parameters': {},
+    }
+
+    disabled = False
+
+    for key, subkey, value in attrs:
+        key = str(key)
+        subkey = (subkey != None) and str(subkey) or None
+
+        if isinstance(value, int):
+            value = int(value)
+        else:
+            value = str(value)
+
+        if subkey == 'disabled' and value:
+            disabled = True
+            break
+
+        if key == 'puppet':
+            if subkey == 'environment' and not 'environment' in result:
+                result['environment'] = value
+
+            if subkey == 'class':
+                if value not in result['classes']:
+                    result['classes'].append(value)
+                continue
+
+            if subkey not in result['parameters']:
+                result['parameters'][subkey] = value
+
+            continue
+
+        paramname = '%s__%s' % ('clusto', key)
+        if subkey:
+            paramname = paramname + '__' + subkey
+
+        if paramname not in result['parameters']:
+            result['parameters'][paramname] = value
+
+    result['parameters']['pools'] = pools
+    result['parameters']['peers'] = peers
+    result['parameters']['siblings'] = siblings
+
+    if disabled:
+        result['classes'] = []
+        result['parameters'] = {}
+
+    if not [x for x in result.values() if x]:
+        return None
+    return result
+
+
+def enc_fingerprint(server):
+    """
+    Return a fingerprint of every attribute the ENC document for server
+    is built from: the attributes of the server and all its containers,
+    the IPs and memberships of its cluster peers, and the public DNS of
+    the siblings listed in the document.
+    """
+    server_id = server.entity.entity_id
+    pools = parents_of([server_id], clusto_types=['pool'])[server_id]
+    clusters = []
+    if pools:
+        query = select([ATTR_TABLE.c.entity_id],
+                       and_(ATTR_TABLE.c.entity_id.in_(pools),
+                            ATTR_TABLE.c.key == 'pooltype',
+                            ATTR_TABLE.c.string_value == 'cluster',
+                            live(ATTR_TABLE)))
+        clusters = set(row[0] for row in clusto.SESSION.execute(query))
+        clusters = [pool for pool in pools if pool in clusters]
+    peers = contents_of(clusters, clusto_types=['server', 'virtualserver'],
+                        search_children=True)
+
+    # siblings are taken from the last peer, if there are any; see generate().
+    subject = peers and peers[-1] or server_id
+    subject_pools = parents_of([subject], clusto_types=['pool'])[subject]
+    siblings = []
+    if subject_pools:
+        # Only the entities in every one of the pools are siblings.
+        query = select([ATTR_TABLE.c.relation_id],
+                       and_(ATTR_TABLE.c.entity_id.in_(subject_pools),
+                            ATTR_TABLE.c.key == '_contains',
+                            live(ATTR_TABLE)))
+        query = query.group_by(ATTR_TABLE.c.relation_id).having(
+            func.count(distinct(ATTR_TABLE.c.entity_id)) == len(set(subject_pools)))
+        siblings = [row[0] for row in clusto.SESSION.execute(query)]
+
+    clauses = [ATTR_TABLE.c.entity_id.in_([server_id] + ancestors_of(server_id))]
+    if peers:
+        clauses.append(and_(ATTR_TABLE.c.entity_id.in_(set(peers)),
+                            ATTR_TABLE.c.key == 'ip',
+                            ATTR_TABLE.c.subkey == 'ipstring'))
+        clauses.append(and_(ATTR_TABLE.c.relation_id.in_(set(peers)),
+                            ATTR_TABLE.c.key == '_contains'))
+    if subject_pools:
+        clauses.append(and_(ATTR_TABLE.c.entity_id.in_(subject_pools),
+                            ATTR_TABLE.c.key == '_contains'))
+    if siblings:
+        clauses.append(and_(ATTR_TABLE.c.entity_id.in_(set(siblings)),
+                            ATTR_TABLE.c.key == 'ec2',
+                            ATTR_TABLE.c.subkey == 'public-dns'))
+    return '%d:%s' % (subject, attr_fingerprint(*clauses))
+
+
+def cluster_peers(cluster_id):
+    """
+    Return the (entity_id, name) of the last server in the cluster, or
+    None if it is empty, and its peers map, which maps the first IP of
+    each server to the names of its parents.
+
+    The map is built with one query per level of the cluster plus one
+    each for the IPs and parents of all the servers, and is cached for
+    the other members of the cluster for as long as the servers' IPs
+    and memberships stay the same.
+    """
+    peers = contents_of([cluster_id], clusto_types=['server', 'virtualserver'],
+                        search_children=True)
+    fingerprint = peers and attr_fingerprint(
+        and_(ATTR_TABLE.c.entity_id.in_(set(peers)),
+             ATTR_TABLE.c.key == 'ip',
+             ATTR_TABLE.c.subkey == 'ipstring'),
+        and_(ATTR_TABLE.c.relation_id.in_(set(peers)),
+             ATTR_TABLE.c.key == '_contains'))
+    cached = PEER_MAPS.get(cluster_id)
+    if cached and cached[0] == (peers, fingerprint):
+        return cached[1]
+
+    ips = string_values_of(peers, 'ip', 'ipstring')
+    parents = parents_of(peers)
+    names = names_of(peers + [p for ids in parents.values() for p in ids])
+    peer_map = {}
+    for peer in peers:
+        if peer in ips:
+            peer_map[str(ips[peer][0])] = [str(names[p]) for p in parents[peer]]
+    result = (peers and (peers[-1], names[peers[-1]]) or None, peer_map)
+    PEER_MAPS[cluster_id] = ((peers, fingerprint), result)
+    return result
+
+
+class Classifier(object):
+
+    """
+    Builds ENC documents for many servers from bulk queries.
+
+    Attributes, memberships and pool contents are loaded for a whole
+    batch of servers at once with prefetch, and anything servers have
+    in common, like their pools and clusters, is only loaded once.
+    """
+
+    def __init__(self):
+        self.attrs = {}
+        self.parents = {}
+        self.entities = {}
+        self.clusters = set()
+        self.members = {}
+        self.public_dns = {}
+
+    def load(self, entity_ids):
+        """Load the parents of entity_ids and the entities involved."""
+        missing = [entity_id for entity_id in entity_ids
+                   if entity_id not in self.parents]
+        if not missing:
+            return
+        parents = parents_of(missing)
+        self.parents.update(parents)
+        wanted = set(missing)
+        for ids in parents.values():
+            wanted.update(ids)
+        wanted.difference_update(self.entities)
+        self.entities.update(entities_of(wanted))
+
+        pools = [entity_id for entity_id in wanted
+                 if self.entities[entity_id].type == 'pool']
+        for batch in batches(pools):
+            query = select([ATTR_TABLE.c.entity_id],
+                           and_(ATTR_TABLE.c.entity_id.in_(batch),
+                                ATTR_TABLE.c.key == 'pooltype',
+                                ATTR_TABLE.c.string_value == 'cluster',
+                                live(ATTR_TABLE)))
+            self.clusters.update(row[0] for row in clusto.SESSION.execute(query))
+
+    def prefetch(self, server_ids):
+        """Load everything needed to classify server_ids."""
+        self.load(server_ids)
+        self.attrs.update(merged_attrs_of([server_id for server_id in server_ids
+                                           if server_id not in self.attrs]))
+
+    def pools(self, entity_id):
+        self.load([entity_id])
+        return [parent for parent in self.parents[entity_id]
+                if self.entities[parent].type == 'pool']
+
+    def siblings(self, entity_id):
+        """
+        Return the public DNS names of the siblings of entity_id, in the
+        order Driver.siblings() returns them.
+        """
+        pools = self.pools(entity_id)
+        missing = [pool for pool in pools if pool not in self.members]
+        if missing:
+            members = dict((pool, contents_of([pool])) for pool in missing)
+            everything = set(member for found in members.values() for member in found)
+            self.entities.update(entities_of(everything.difference(self.entities)))
+            wanted = everything.difference(self.public_dns)
+            values = string_values_of(wanted, 'ec2', 'public-dns')
+            for member in wanted:
+                self.public_dns[member] = values.get(member, [None])[0]
+            for pool, found in members.items():
+                self.members[pool] = [(self.entities[member].name, member)
+                                      for member in found]
+
+        name = self.entities[entity_id].name
+        return [str(self.public_dns[member]) for sibling, member
+                in pool_intersection([self.members[pool] for pool in pools])
+                if sibling != name]
+
+    def classify(self, server_id):
+        """Return the ENC document for server_id as generate() would."""
+        self.prefetch([server_id])
+        attrs = ((row.key, row.subkey, row_value(row)) for row in self.attrs[server_id])
+        pools = self.pools(server_id)
+
+        peers = {}
+        subject = server_id
+        for pool in pools:
+            if pool in self.clusters:
+                last, peer_map = cluster_peers(pool)
+                peers.update(peer_map)
+                if last:
+                    subject = last[0]
+
+        return build(attrs, [str(self.entities[pool].name) for pool in pools],
+                     peers, self.siblings(subject))
+
+
+def classify_batch(server_ids):
+    """
+    Return (name, rendered document or None, error or None) for each of
+    server_ids. This is what worker processes run for bulk generation.
+    """
+    classifier = Classifier()
+    classifier.prefetch(server_ids)
+    results = []
+    for server_id in server_ids:
+        name = classifier.entities[server_id].name
+        try:
+            result = classifier.classify(server_id)
+            results.append((name, result and render(result), None))
+        except Exception, e:
+            results.append((name, None, str(e)))
+    return results
+
 
 class PuppetNode2(script_helper.Script):
+    _usage = """
+             clusto-puppet-node2 hostname [--cache-dir DIR] [--cache-ttl N]
+             clusto-puppet-node2 --port PORT [--listen ADDR]
+                                 [--cache-size N] [--cache-ttl N]
+             clusto-puppet-node2 (--all | --pool POOL [--pool POOL ...])
+                                 [--output-dir DIR] [--processes N]
+
+             Print the puppet external node classification for hostname.
+
+             With --port, serve GET /node/<hostname> over HTTP instead,
+             returning the same YAML. Use clusto-puppet-enc as the
+             external_nodes script to query it.
+
+             With --all or --pool, classify every server, or every
+             server in the given pools, in one pass. The documents are
+             printed as one multi-document YAML stream, each preceded
+             by a "# <name>" comment line, or written to
+             DIR/<name>.yaml with --output-dir.
+             """
+
+    def __init__(self):
+        script_helper.Script.__init__(self)
+        self.documents = None
+        self.aliases = LRUCache(maxsize=16384, ttl=300)
+        self.unknown = LRUCache(maxsize=16384, ttl=60)
+
     def lookup(self, name):
-        try:
-            server = clusto.get_by_name(name)
-            return server
-        except LookupError:
+        """
+        Return the server name refers to, or False. name may be the
+        server's name or short name, its system hostname, or its EC2
+        private or public DNS name. Names which match nothing are
+        remembered for a minute.
+        """
+        if name in self.unknown:
+            return False
+        entity_name = self.aliases.get(name)
+        if entity_name is not None:
+            try:
+                return clusto.get_by_name(entity_name)
+            except LookupError:
+                # renamed or deleted since it was cached
+                self.aliases.pop(name)
+
+        entity_name = resolve_hostname(name)
+        if entity_name is not None:
             try:
-                server = clusto.get_by_name(name.split('.', 1)[0])
+                server = clusto.get_by_name(entity_name)
+                self.aliases[name] = entity_name
                 return server
             except LookupError:
-                return False
+                pass
+        self.unknown[name] = True
+        return False
 
-    def run(self, args):
-        server = self.lookup(args.hostname)
-        if not server:
-            server = self.lookup('default')
-        if not server:
-            return -1
+    def generate(self, server, max_age=None):
+        """
+        Return the ENC document for server as a dict, or None if it
+        would be empty. Inherited attributes may be up to max_age
+        seconds old; by default, as old as EFFECTIVE_ATTRS allows.
+        """
+        attrs = ((row.key, row.subkey, row_value(row))
+                 for row in EFFECTIVE_ATTRS.attrs(server.entity.entity_id, max_age))
+        pools = [str(p.name) for p in server.parents(clusto_types=['pool'])]
 
-        result = {
-            'classes': [],
-            'parameters': {},
-        }
+        clusters = [p for p in server.parents(clusto_types=['pool']) if p.attr_values('pooltype', value='cluster')]
 
-        disabled = False
+        peers = {}
+        for c in clusters:
+            last, peer_map = cluster_peers(c.entity.entity_id)
+            peers.update(peer_map)
 
-        for attr in server.attrs(merge_container_attrs=True):
-            key = str(attr.key)
-            subkey = (attr.subkey != None) and str(attr.subkey) or None
+            # siblings have always been those of the last peer listed
+            if last:
+                server = clusto.get_by_name(last[1])
 
-            if isinstance(attr.value, int):
-                value = int(attr.value)
-            else:
-                value = str(attr.value)
+        siblings = Classifier().siblings(server.entity.entity_id)
+        return build(attrs, pools, peers, siblings)
 
-            if subkey == 'disabled' and value:
-                disabled = True
-                break
+    def cached(self, server, args):
+        """
+        Return the rendered ENC document for server, reusing the copy
+        in args.cache_dir if its inputs have not changed since it was
+        rendered and it is younger than args.cache_ttl seconds.
+        """
+        path = os.path.join(args.cache_dir, '%s.yaml' % server.name)
+        fingerprint = enc_fingerprint(server)
+        try:
+            if os.stat(path).st_mtime + args.cache_ttl > time.time():
+                fd = open(path, 'r')
+                try:
+                    header = fd.readline()
+                    if header.strip() == '# fingerprint %s' % fingerprint:
+                        return fd.read()
+                finally:
+                    fd.close()
+        except (IOError, OSError):
+            pass
 
-            if key == 'puppet':
-                if subkey == 'environment' and not 'environment' in result:
-                    result['environment'] = value
+        # The document is stored under the current fingerprint, so it
+        # must not be built from an older view of the containers.
+        result = self.generate(server, max_age=0)
+        if result is None:
+            return None
+        output = render(result)
+        try:
+            write_file(path, '# fingerprint %s\n%s' % (fingerprint, output))
+        except (IOError, OSError), e:
+            sys.stderr.write('Unable to cache ENC for %s: %s\n' % (server.name, e))
+        return output
 
-                if subkey == 'class':
-                    if value not in result['classes']:
-                        result['classes'].append(value)
-                    continue
+    def document(self, hostname):
+        """
+        Return the rendered ENC document for hostname, or None if there
+        isn't one. Documents are kept in memory and reused for as long
+        as their fingerprint is unchanged.
+        """
+        server = self.lookup(hostname) or self.lookup('default')
+        if not server:
+            return None
+        fingerprint = enc_fingerprint(server)
+        cached = self.documents.get(server.name)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+        # The document is stored under the current fingerprint, so it
+        # must not be built from an older view of the containers.
+        result = self.generate(server, max_age=0)
+        output = result and render(result)
+        self.documents[server.name] = (fingerprint, output)
+        return output
 
-                if subkey not in result['parameters']:
-                    result['parameters'][subkey] = value
+    def app(self, environ, start_response):
+        """WSGI app serving GET /node/<hostname>."""
+        path = environ.get('PATH_INFO', '')
+        if environ['REQUEST_METHOD'] != 'GET' or not path.startswith('/node/'):
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['Not found\n']
 
-                continue
+        clusto.clear()
+        try:
+            output = self.document(path[len('/node/'):])
+        except Exception, e:
+            self.error('Unable to classify %s: %s' % (path[len('/node/'):], e))
+            start_response('500 Internal Server Error',
+                           [('Content-Type', 'text/plain')])
+            return ['%s\n' % e]
+        if not output:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['Not found\n']
 
-            paramname = '%s__%s' % ('clusto', key)
-            if subkey:
-                paramname = paramname + '__' + subkey
+        start_response('200 OK', [('Content-Type', 'text/yaml'),
+                                  ('Content-Length', str(len(output)))])
+        return [output]
 
-            if paramname not in result['parameters']:
-                result['parameters'][paramname] = value
+    def serve(self, args):
+        """
+        Serve ENC documents over HTTP until killed, keeping the clusto
+        connection and the rendered documents warm between requests.
+        """
+        self.documents = LRUCache(maxsize=args.cache_size, ttl=args.cache_ttl)
+        self.info('Serving ENC documents on %s:%d' % (args.listen, args.port))
+        eventlet.wsgi.server(eventlet.listen((args.listen, args.port)), self.app)
 
-        result['parameters']['pools'] = [str(p.name) for p in server.parents(clusto_types=['pool'])]
-    
-        clusters = [p for p in server.parents(clusto_types=['pool']) if p.attr_values('pooltype', value='cluster')]
+    def select(self, args):
+        """Return the entity_ids of the servers to classify in bulk, by name."""
+        types = ['server', 'virtualserver']
+        if args.pool:
+            pools = [clusto.get_by_name(name).entity.entity_id for name in args.pool]
+            server_ids = set(contents_of(pools, clusto_types=types, search_children=True))
+        else:
+            query = select([ENTITY_TABLE.c.entity_id],
+                           and_(ENTITY_TABLE.c.type.in_(types), live(ENTITY_TABLE)))
+            server_ids = set(row[0] for row in clusto.SESSION.execute(query))
+        names = names_of(server_ids)
+        return sorted(server_ids, key=lambda server_id: names[server_id])
 
-        peers = {}
-        for c in clusters:
-            servers = c.contents(search_children=True, clusto_types=['server', 'virtualserver'])
+    def bulk(self, args):
+        """Classify many servers at once, batch by batch."""
+        chunks = batches(self.select(args))
+        if args.output_dir and not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
 
-            for server in servers:
-                if server not in peers:
-                    ips = server.get_ips()
-                    if ips:
-                        peers[str(ips[0])] = [str(x.name) for x in server.parents()]
+        workers = None
+        if args.processes > 1:
+            # Workers must open their own connections, not share ours.
+            clusto.SESSION.remove()
+            clusto.SESSION.bind.dispose()
+            workers = ProcessPool(args.processes)
+            results = workers.imap(classify_batch, chunks)
+        else:
+            results = (classify_batch(chunk) for chunk in chunks)
 
-        result['parameters']['peers'] = peers
-        result['parameters']['siblings'] = [str(sib.attr_value(key='ec2', subkey='public-dns')) for sib in server.siblings()]
+        failed = 0
+        for batch in results:
+            for name, output, error in batch:
+                if error:
+                    self.error('Unable to classify %s: %s' % (name, error))
+                    failed += 1
+                elif not output:
+                    continue
+                elif args.output_dir:
+                    write_file(os.path.join(args.output_dir, '%s.yaml' % name), output)
+                else:
+                    sys.stdout.write('# %s\n%s' % (name, output))
+
+        if workers:
+            workers.close()
+            workers.join()
+        if failed:
+            return -1
+
+    def run(self, args):
+        if args.port:
+            return self.serve(args)
+        if args.all or args.pool:
+            return self.bulk(args)
+        if not args.hostname:
+            self.error('A hostname is required unless --port, --all or --pool is given')
+            return -1
 
-        if disabled:
-            result['classes'] = []
-            result['parameters'] = {}
+        server = self.lookup(args.hostname)
+        if not server:
+            server = self.lookup('default')
+        if not server:
+            return -1
 
-        if not [x for x in result.values() if x]:
+        if args.cache_dir:
+            output = self.cached(server, args)
+        else:
+            result = self.generate(server)
+            output = result and render(result)
+        if not output:
             return -1
 
-        yaml.dump(result, sys.stdout, default_flow_style=False, explicit_start=True, indent=2)
+        sys.stdout.write(output)
 
     def _add_arguments(self, parser):
-        parser.add_argument('hostname')
+        parser.add_argument('hostname', nargs='?', default=None)
+        parser.add_argument('--port', type=int, default=None,
+                            help='Serve GET /node/<hostname> on this port '
+                                 'instead of printing one document')
+        parser.add_argument('--listen', default='127.0.0.1',
+                            help='Address to serve on with --port')
+        parser.add_argument('--cache-size', type=int, default=16384,
+                            help='Number of documents kept in memory with --port')
+        parser.add_argument('--all', action='store_true', default=False,
+                            help='Classify every server')
+        parser.add_argument('--pool', action='append', default=[],
+                            help='Classify every server in this pool')
+        parser.add_argument('--output-dir', default=None,
+                            help='Write each document to DIR/<name>.yaml '
+                                 'with --all or --pool')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Number of processes to classify in '
+                                 'with --all or --pool')
+        parser.add_argument('--cache-dir', default=None,
+                            help='Reuse ENC documents cached in this directory '
+                                 'while their inputs are unchanged')
+        parser.add_argument('--cache-ttl', type=int, default=3600,
+                            help='Maximum age in seconds of a cached document')
+        parser.usage = self._usage
 
     def add_subparser(self, subparsers):
         parser = self._setup_subparser(subparsers)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# © 2011 SimpleGeo, Inc. All rights reserved.
+#
+
+"""Small in-process caches."""
+
+import threading
+import time
+
+
+class LRUCache(object):
+
+    """
+    A bounded mapping which evicts the least recently used key.
+
+    If ttl is given, entries older than ttl seconds are treated as
+    missing, which forces callers to refresh them periodically.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Forget every entry."""
+        with self.lock:
+            self.map = {}
+            # Circular doubly-linked list of [prev, next, key] links,
+            # oldest first.
+            self.root = root = []
+            root[:] = [root, root, None]
+
+    def __len__(self):
+        return len(self.map)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        root = self.root
+        last = root[0]
+        link[0], link[1] = last, root
+        last[1] = root[0] = link
+
+    def get(self, key, default=None):
+        """Return the value for key, or default if missing or expired."""
+        with self.lock:
+            if key not in self.map:
+                return default
+            link, value, stored = self.map[key]
+            if self.ttl is not None and time.time() - stored > self.ttl:
+                self._unlink(link)
+                del self.map[key]
+                return default
+            self._unlink(link)
+            self._append(link)
+            return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key in self.map:
+                link = self.map[key][0]
+                self._unlink(link)
+            else:
+                link = [None, None, key]
+            self._append(link)
+            self.map[key] = (link, value, time.time())
+            while len(self.map) > self.maxsize:
+                oldest = self.root[1]
+                self._unlink(oldest)
+                del self.map[oldest[2]]
+
+    def __delitem__(self, key):
+        with self.lock:
+            link = self.map.pop(key)[0]
+            self._unlink(link)
+
+    def pop(self, key, default=None):
+        """Remove key and return its value, or default if missing."""
+        with self.lock:
+            value = self.get(key, self)
+            if value is self:
+                return default
+            del self[key]
+            return value
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+# © 2011 SimpleGeo, Inc. All rights reserved.
+#
+
+"""A queue which keeps only the newest pending item per key."""
+
+from collections import deque
+from Queue import Empty
+import threading
+import time
+
+
+class CoalescingQueue(object):
+
+    """
+    A FIFO queue of keys, each holding only its most recent item.
+
+    Putting an item for a key which is already pending replaces the
+    pending item but keeps the key's place in line, so every key is
+    served in the order it first became pending and no key's latest
+    item is ever dropped. The size of the queue is bounded by the
+    number of distinct keys rather than by the rate of puts.
+    """
+
+    def __init__(self):
+        self.order = deque()
+        self.pending = {}
+        self.replaced = 0
+        self.cond = threading.Condition()
+
+    def qsize(self):
+        return len(self.order)
+
+    def put(self, key, item):
+        """
+        Queue item for key, replacing any pending item for it. Returns
+        the item that was replaced, or None.
+        """
+        with self.cond:
+            previous = self.pending.get(key)
+            if key in self.pending:
+                self.replaced += 1
+            else:
+                self.order.append(key)
+            self.pending[key] = item
+            self.cond.notify()
+            return previous
+
+    def get(self, block=True, timeout=None):
+        """
+        Remove and return the item for the longest-waiting key.
+
+        Raises Queue.Empty if nothing is pending and block is False, or
+        if timeout seconds pass without an item arriving.
+        """
+        with self.cond:
+            if block and timeout is not None:
+                deadline = time.time() + timeout
+            while not self.order:
+                if not block:
+                    raise Empty
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    self.cond.wait(remaining)
+            key = self.order.popleft()
+            return self.pending.pop(key)
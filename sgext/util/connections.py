@@ -6,6 +6,7 @@
 
 """Generic connection-handling code."""
 
+import logging
 import time
 import socket
 from functools import wraps
@@ -15,6 +16,10 @@ from operator import itemgetter
 
 from decorator import decorator
 from ostrich import stats
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+import clusto
 
 
 class throttle(object):
@@ -46,9 +51,12 @@ class throttle(object):
         return __inner__
 
 
-def retry(max_=3, delay=0, exceptions=None):
+def retry(max_=3, delay=0, exceptions=None, name=None):
     """Retry some number of times.
 
+    Retries are counted in the `name'_retry stat; name defaults to the
+    wrapped function's repr, which includes its address.
+
     WARNING: This decorator assumes the wrapped function is
     idempotent; that is, that it will perform the same operation when
     called multiple times, and that it does not mutate its arguments
@@ -67,7 +75,7 @@ def retry(max_=3, delay=0, exceptions=None):
             try:
                 return func(*args, **kwargs)
             except exceptions, ex:
-                stats.incr('%s_retry' % str(func))
+                stats.incr('%s_retry' % (name or str(func)))
                 logging.warning("Caught %s on %s attempt %d/%d",
                               repr(ex), str(func), attempts, max_)
                 time.sleep(delay)
@@ -77,7 +85,7 @@ def retry(max_=3, delay=0, exceptions=None):
 
                 logging.exception("Retries of %s exceeded, giving up.",
                                   str(func))
-                stats.incr('%s_retry_failure' % str(func))
+                stats.incr('%s_retry_failure' % (name or str(func)))
                 raise
 
     return __wrapper__
@@ -129,6 +137,33 @@ def backoff(limit=600, recent=10, exceptions=None):
     return __wrapper__
 
 
+def size_pool(size):
+    """Rebind clusto's session to an engine of size connections.
+
+    clusto.connect binds a SingletonThreadPool, which keeps one
+    connection per thread but closes the oldest once more than five
+    threads have one, even while they are still in use. Commands which
+    use the database from more threads or greenthreads than that
+    should call this first. Threads wait for a free connection rather
+    than opening more than size. In-memory SQLite databases exist only
+    on their one connection, so they are left alone.
+    """
+    engine = clusto.SESSION.bind
+    url = engine.url
+    connect_args = {}
+    if url.drivername.startswith('sqlite'):
+        if url.database in (None, '', ':memory:'):
+            return
+        connect_args['check_same_thread'] = False
+    clusto.SESSION.remove()
+    clusto.SESSION.configure(bind=create_engine(url, echo=engine.echo,
+                                                poolclass=QueuePool,
+                                                pool_size=size, max_overflow=0,
+                                                pool_recycle=600,
+                                                connect_args=connect_args))
+    engine.dispose()
+
+
 def ratelimit(sequence, ns):
     """Rate-limit consumption of sequence to n per second."""
     avg = 0
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+# © 2011 SimpleGeo, Inc. All rights reserved.
+#
+
+"""A flattened, incrementally refreshed view of inherited attributes."""
+
+import threading
+import time
+
+import clusto
+from clusto.schema import ATTR_TABLE
+from sqlalchemy import and_, func, or_, select
+
+from sgext.util.query import batches, live, merge_rows, parents_of
+
+
+class EffectiveAttrs(object):
+
+    """
+    The attributes each entity has once its containers' are merged in,
+    as attrs(merge_container_attrs=True) returns them.
+
+    The attributes and parents of containers are kept in memory, so
+    reading an entity's effective attributes fetches only its own
+    attributes and memberships, in one query. At most every max_age
+    seconds the containers are checked for changes to their attributes
+    or memberships since they were loaded, and only the ones which
+    changed are reloaded.
+    """
+
+    def __init__(self, max_age=5):
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Forget every container, e.g. after a rollback."""
+        with self.lock:
+            self.rows = {}
+            self.parents = {}
+            self.stamps = {}
+            self.checked = time.time()
+
+    def stamps_of(self, container_ids):
+        """
+        Return a dict mapping each of container_ids to a stamp of its
+        attributes and one of its memberships, which change whenever
+        any of them are added or deleted.
+        """
+        stamp = [func.count(ATTR_TABLE.c.attr_id), func.sum(ATTR_TABLE.c.attr_id),
+                 func.max(ATTR_TABLE.c.attr_id)]
+        own = {}
+        memberships = {}
+        for batch in batches(container_ids):
+            query = select([ATTR_TABLE.c.entity_id] + stamp,
+                           and_(ATTR_TABLE.c.entity_id.in_(batch),
+                                ATTR_TABLE.c.key != '_contains',
+                                live(ATTR_TABLE))).group_by(ATTR_TABLE.c.entity_id)
+            for row in clusto.SESSION.execute(query):
+                own[row[0]] = tuple(row[1:])
+            query = select([ATTR_TABLE.c.relation_id] + stamp,
+                           and_(ATTR_TABLE.c.relation_id.in_(batch),
+                                ATTR_TABLE.c.key == '_contains',
+                                live(ATTR_TABLE))).group_by(ATTR_TABLE.c.relation_id)
+            for row in clusto.SESSION.execute(query):
+                memberships[row[0]] = tuple(row[1:])
+        return dict((container, (own.get(container), memberships.get(container)))
+                    for container in container_ids)
+
+    def load(self, container_ids):
+        """Load container_ids and every container above them."""
+        level = set(container_ids)
+        while level:
+            # Stamp first, so a change made while loading is seen as one
+            # on the next refresh rather than missed.
+            self.stamps.update(self.stamps_of(level))
+            for container in level:
+                self.rows[container] = []
+            for batch in batches(level):
+                query = select([ATTR_TABLE],
+                               and_(ATTR_TABLE.c.entity_id.in_(batch),
+                                    ATTR_TABLE.c.key != '_contains',
+                                    live(ATTR_TABLE))).order_by(ATTR_TABLE.c.attr_id)
+                for row in clusto.SESSION.execute(query):
+                    if not row.key.startswith('_'):
+                        self.rows[row.entity_id].append(row)
+            parents = parents_of(level)
+            self.parents.update(parents)
+            level = set(parent for child in level for parent in parents[child]
+                        if parent not in self.parents)
+
+    def refresh(self, max_age=None):
+        """
+        Reload the containers which changed since they were loaded, if
+        they were last checked more than max_age seconds ago. max_age
+        defaults to the view's own.
+        """
+        if max_age is None:
+            max_age = self.max_age
+        if time.time() - self.checked < max_age:
+            return
+        self.checked = time.time()
+        stamps = self.stamps_of(self.stamps.keys())
+        changed = [container for container, stamp in stamps.items()
+                   if stamp != self.stamps[container]]
+        for container in changed:
+            del self.parents[container]
+        self.load(changed)
+
+    def attrs(self, entity_id, max_age=None):
+        """
+        Return the effective attribute rows of entity_id, checking the
+        containers for changes first if they were last checked more than
+        max_age seconds ago.
+        """
+        clusto.SESSION.flush()
+        query = select([ATTR_TABLE],
+                       and_(or_(ATTR_TABLE.c.entity_id == entity_id,
+                                and_(ATTR_TABLE.c.relation_id == entity_id,
+                                     ATTR_TABLE.c.key == '_contains')),
+                            live(ATTR_TABLE))).order_by(ATTR_TABLE.c.attr_id)
+        rows = []
+        parents = []
+        for row in clusto.SESSION.execute(query):
+            if row.entity_id == entity_id:
+                rows.append(row)
+            else:
+                parents.append(row.entity_id)
+
+        with self.lock:
+            self.refresh(max_age)
+            self.load([parent for parent in parents if parent not in self.parents])
+            return merge_rows(rows, parents, self.rows, self.parents)
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+#
+# © 2011 SimpleGeo, Inc. All rights reserved.
+#
+
+"""Set-based queries against the clusto schema.
+
+The driver API answers most questions by loading an entity's whole
+attribute list and filtering it in Python. The functions here ask the
+database the narrower question directly.
+"""
+
+import clusto
+from clusto.schema import ATTR_TABLE, ENTITY_TABLE, Attribute
+from sqlalchemy import and_, func, literal, or_, select, union_all
+
+
+def batches(ids, size=500):
+    """Split ids into lists of at most size, to keep IN clauses bounded."""
+    ids = list(ids)
+    return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+
+def live(table):
+    """Return a clause matching rows of table which are not deleted."""
+    return table.c.deleted_at_version == None
+
+
+def is_member(container, thing):
+    """
+    Return True if thing is a direct member of container.
+
+    This is `thing in container` as a single point query, rather than a
+    scan of every _contains attribute of the container. The relation_id
+    foreign key is indexed, so only the few rows naming thing are read.
+    """
+    clusto.SESSION.flush()
+    query = select([ATTR_TABLE.c.attr_id],
+                   and_(ATTR_TABLE.c.entity_id == container.entity.entity_id,
+                        ATTR_TABLE.c.key == '_contains',
+                        ATTR_TABLE.c.relation_id == thing.entity.entity_id,
+                        live(ATTR_TABLE))).limit(1)
+    return clusto.SESSION.execute(query).first() is not None
+
+
+def parents_of(entity_ids, clusto_types=None):
+    """
+    Return a dict mapping each of entity_ids to the ids of the
+    entities directly containing it, in the order they were inserted.
+    """
+    entity_ids = list(entity_ids)
+    parents = dict((entity_id, []) for entity_id in entity_ids)
+    if not entity_ids:
+        return parents
+    for batch in batches(set(entity_ids)):
+        clauses = [ATTR_TABLE.c.key == '_contains',
+                   ATTR_TABLE.c.relation_id.in_(batch),
+                   live(ATTR_TABLE)]
+        if clusto_types:
+            clauses += [ENTITY_TABLE.c.entity_id == ATTR_TABLE.c.entity_id,
+                        ENTITY_TABLE.c.type.in_(clusto_types)]
+        query = select([ATTR_TABLE.c.relation_id, ATTR_TABLE.c.entity_id],
+                       and_(*clauses)).order_by(ATTR_TABLE.c.attr_id)
+        for child, parent in clusto.SESSION.execute(query):
+            parents[child].append(parent)
+    return parents
+
+
+def entities_of(entity_ids):
+    """Return a dict mapping each of entity_ids to its entities row."""
+    entities = {}
+    for batch in batches(set(entity_ids)):
+        query = select([ENTITY_TABLE], ENTITY_TABLE.c.entity_id.in_(batch))
+        for row in clusto.SESSION.execute(query):
+            entities[row.entity_id] = row
+    return entities
+
+
+def names_of(entity_ids):
+    """Return a dict mapping each of entity_ids to its entity name."""
+    names = {}
+    for batch in batches(set(entity_ids)):
+        query = select([ENTITY_TABLE.c.entity_id, ENTITY_TABLE.c.name],
+                       ENTITY_TABLE.c.entity_id.in_(batch))
+        names.update(clusto.SESSION.execute(query).fetchall())
+    return names
+
+
+def ids_of(names):
+    """Return a dict mapping each of names which exists to its entity_id."""
+    ids = {}
+    for batch in batches(set(names)):
+        query = select([ENTITY_TABLE.c.name, ENTITY_TABLE.c.entity_id],
+                       and_(ENTITY_TABLE.c.name.in_(batch), live(ENTITY_TABLE)))
+        ids.update(clusto.SESSION.execute(query).fetchall())
+    return ids
+
+
+def string_values_of(entity_ids, key, subkey=None):
+    """
+    Return a dict mapping each of entity_ids to the string values of its
+    key/subkey attributes, in the order they were added. Entities
+    without the attribute are left out.
+    """
+    values = {}
+    for batch in batches(set(entity_ids)):
+        query = select([ATTR_TABLE.c.entity_id, ATTR_TABLE.c.string_value],
+                       and_(ATTR_TABLE.c.entity_id.in_(batch),
+                            ATTR_TABLE.c.key == key,
+                            ATTR_TABLE.c.subkey == subkey,
+                            live(ATTR_TABLE))).order_by(ATTR_TABLE.c.attr_id)
+        for entity_id, value in clusto.SESSION.execute(query):
+            values.setdefault(entity_id, []).append(value)
+    return values
+
+
+def ancestors_of(entity_id):
+    """
+    Return the ids of every container above entity_id, nearest first,
+    in the order merge_container_attrs visits them.
+    """
+    ancestors = []
+    level = [entity_id]
+    seen = set(level)
+    while level:
+        parents = parents_of(level)
+        level = [parent for child in level for parent in parents[child]
+                 if parent not in seen]
+        seen.update(level)
+        ancestors.extend(level)
+    return ancestors
+
+
+def merge_rows(rows, parents, attrs, containers):
+    """
+    Return rows followed by the attribute rows of every container above
+    them, in the order attrs(merge_container_attrs=True) returns them.
+    Hidden attributes are left out.
+
+    parents are the ids of the direct containers, attrs maps container
+    ids to their rows and containers maps them to their own parents.
+    """
+    rows = list(rows)
+    # Each level is every container of the level below, as a set;
+    # a repeated level means the containers form a cycle.
+    level = frozenset(parents)
+    seen = set()
+    while level and level not in seen:
+        seen.add(level)
+        for container in sorted(level):
+            rows.extend(attrs[container])
+        level = frozenset(parent for child in level for parent in containers[child])
+    return sorted([row for row in rows if not row.key.startswith('_')],
+                  key=lambda row: row.key)
+
+
+def merged_attrs_of(entity_ids):
+    """
+    Return a dict mapping each of entity_ids to its attribute rows
+    followed by those of its containers, in the order
+    attrs(merge_container_attrs=True) would return them. Hidden
+    attributes are left out.
+
+    Containers are found one level at a time for all of entity_ids
+    together, and their attributes are read once however many of
+    entity_ids share them.
+    """
+    entity_ids = list(entity_ids)
+    parents = {}
+    level = set(entity_ids)
+    while level:
+        parents.update(parents_of(level))
+        level = set(parent for child in level for parent in parents[child]
+                    if parent not in parents)
+
+    attrs = dict((entity_id, []) for entity_id in parents)
+    for batch in batches(parents):
+        query = select([ATTR_TABLE], and_(ATTR_TABLE.c.entity_id.in_(batch),
+                                          live(ATTR_TABLE)))
+        query = query.order_by(ATTR_TABLE.c.entity_id, ATTR_TABLE.c.attr_id)
+        for row in clusto.SESSION.execute(query):
+            attrs[row.entity_id].append(row)
+
+    return dict((entity_id, merge_rows(attrs[entity_id], parents[entity_id], attrs, parents))
+                for entity_id in entity_ids)
+
+
+def row_value(row):
+    """Return the value of an entity_attrs row, as Attribute.value does."""
+    if row.datatype == 'int':
+        return int(row.int_value)
+    if row.datatype == 'string':
+        return row.string_value
+    return Attribute.query().filter(Attribute.attr_id == row.attr_id).one().value
+
+
+def contents_of(container_ids, clusto_types=None, search_children=False):
+    """
+    Return the ids of the entities in container_ids, in the same order
+    contents() would return them for each container in turn.
+
+    With search_children, the contents of contained entities follow
+    their parent's contents, depth first. The descendants are fetched
+    with one query per level rather than one per container.
+    clusto_types filters the result, not the search.
+    """
+    members = {}
+    level = set(container_ids)
+    while level:
+        for container in level:
+            members[container] = []
+        for batch in batches(level):
+            query = select([ATTR_TABLE.c.entity_id, ATTR_TABLE.c.relation_id],
+                           and_(ATTR_TABLE.c.key == '_contains',
+                                ATTR_TABLE.c.entity_id.in_(batch),
+                                live(ATTR_TABLE))).order_by(ATTR_TABLE.c.attr_id)
+            for container, member in clusto.SESSION.execute(query):
+                members[container].append(member)
+        if not search_children:
+            break
+        level = set(member for container in level for member in members[container]
+                    if member not in members)
+
+    wanted = None
+    if clusto_types:
+        wanted = set()
+        everything = set(member for found in members.values() for member in found)
+        for batch in batches(everything):
+            query = select([ENTITY_TABLE.c.entity_id],
+                           and_(ENTITY_TABLE.c.entity_id.in_(batch),
+                                ENTITY_TABLE.c.type.in_(clusto_types),
+                                live(ENTITY_TABLE)))
+            wanted.update(row[0] for row in clusto.SESSION.execute(query))
+
+    def ordered(entity_ids):
+        # contents() loads members 500 at a time, each lot in id order
+        found = []
+        for batch in batches(entity_ids):
+            found.extend(sorted(batch))
+        return found
+
+    def walk(container, path):
+        found = ordered([member for member in members.get(container, [])
+                         if wanted is None or member in wanted])
+        if search_children:
+            for child in ordered(members.get(container, [])):
+                if members.get(child) and child not in path:
+                    found.extend(walk(child, path | set([child])))
+        return found
+
+    found = []
+    for container in container_ids:
+        found.extend(walk(container, set([container])))
+    return found
+
+
+def pool_intersection(pools):
+    """
+    Return the (name, entity_id) pairs found in every one of pools,
+    each a list of the (name, entity_id) pairs in one pool, in the
+    order clusto.get_from_pools would return them.
+
+    get_from_pools intersects sets of Drivers, which hash and compare
+    by name; sets of the names built in the same order iterate in the
+    same order.
+    """
+    ids = {}
+    sets = []
+    for members in pools:
+        ids.update(members)
+        sets.append(set(name for name, entity_id in members))
+    return [(name, ids[name]) for name in reduce(set.intersection, sets)]
+
+
+def resolve_hostname(hostname):
+    """
+    Return the name of the entity hostname refers to, or None.
+
+    hostname may be the entity's name or its short name, its system
+    hostname, or its EC2 private or public DNS name, which are preferred
+    in that order. All of them are looked for with a single query.
+    """
+    short = hostname.split('.', 1)[0]
+    names = set([hostname, short])
+    ranks = {
+        ('name', hostname): 0, ('name', short): 1,
+        ('system', hostname): 2, ('system', short): 3,
+        ('ec2', hostname): 4,
+    }
+    by_name = select([ENTITY_TABLE.c.name, literal('name').label('source'),
+                      ENTITY_TABLE.c.name.label('value')],
+                     and_(ENTITY_TABLE.c.name.in_(names), live(ENTITY_TABLE)))
+    by_attr = select([ENTITY_TABLE.c.name, ATTR_TABLE.c.key, ATTR_TABLE.c.string_value],
+                     and_(ENTITY_TABLE.c.entity_id == ATTR_TABLE.c.entity_id,
+                          live(ENTITY_TABLE), live(ATTR_TABLE),
+                          or_(and_(ATTR_TABLE.c.key == 'system',
+                                   ATTR_TABLE.c.subkey == 'hostname',
+                                   ATTR_TABLE.c.string_value.in_(names)),
+                              and_(ATTR_TABLE.c.key == 'ec2',
+                                   ATTR_TABLE.c.subkey.in_(['private-dns', 'public-dns']),
+                                   ATTR_TABLE.c.string_value == hostname))))
+    found = [(ranks.get((source, value), len(ranks)), name)
+             for name, source, value in clusto.SESSION.execute(union_all(by_name, by_attr))]
+    return found and min(found)[1] or None
+
+
+def attr_fingerprint(*clauses):
+    """
+    Return a string which changes whenever a live attribute matching any
+    of clauses is added or deleted, or an integer one is changed.
+
+    set_attr deletes and re-adds attributes rather than updating them,
+    so the count, sum and maximum of the matching attr_ids are enough to
+    notice most changes without reading the attributes. The barker
+    consumer updates last_updated in place, so the sum of the integer
+    values is included too.
+    """
+    if not clauses:
+        return ''
+    query = select([func.count(ATTR_TABLE.c.attr_id),
+                    func.sum(ATTR_TABLE.c.attr_id),
+                    func.max(ATTR_TABLE.c.attr_id),
+                    func.sum(ATTR_TABLE.c.int_value)],
+                   and_(live(ATTR_TABLE), or_(*clauses)))
+    return ':'.join(str(x) for x in clusto.SESSION.execute(query).first())
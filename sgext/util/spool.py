@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# © 2011 SimpleGeo, Inc. All rights reserved.
+#
+
+"""An append-only, segmented on-disk spool of JSON records."""
+
+import json
+import mmap
+import os
+
+
+class Spool(object):
+
+    """
+    Append-only spool of JSON records, one per line, split into
+    numbered segment files in directory.
+
+    Records are appended to the newest segment, which is closed and a
+    new one started once it grows past segment_size bytes. Segments are
+    read back oldest first with pop_segment, which deletes the segment
+    once it has been read. Segments left over from a previous process
+    are picked up on startup.
+    """
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, use_mmap=False):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.use_mmap = use_mmap
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.segments = sorted(int(name.split('.')[0])
+                               for name in os.listdir(directory)
+                               if name.endswith('.spool'))
+        self.current = None
+
+    def path(self, segment):
+        return os.path.join(self.directory, '%020d.spool' % segment)
+
+    def __len__(self):
+        """Return the number of segments holding records."""
+        return len(self.segments) + (self.current is not None)
+
+    def append(self, record):
+        """Append record to the newest segment."""
+        if self.current is None:
+            segment = (self.segments[-1] + 1) if self.segments else 0
+            self.current = (segment, open(self.path(segment), 'ab'))
+        segment, fd = self.current
+        fd.write(json.dumps(record, separators=(',', ':')) + '\n')
+        fd.flush()
+        if fd.tell() >= self.segment_size:
+            self.rotate()
+
+    def rotate(self):
+        """Close the newest segment so it can be read back."""
+        if self.current is None:
+            return
+        segment, fd = self.current
+        fd.close()
+        self.segments.append(segment)
+        self.current = None
+
+    def read(self, segment):
+        """
+        Return the records in segment, in the order they were written.
+        A partially written last line, left by a crash, is skipped.
+        """
+        fd = open(self.path(segment), 'rb')
+        try:
+            if self.use_mmap and os.fstat(fd.fileno()).st_size:
+                data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    return self._parse(iter(data.readline, ''))
+                finally:
+                    data.close()
+            return self._parse(fd)
+        finally:
+            fd.close()
+
+    def _parse(self, lines):
+        records = []
+        for line in lines:
+            if not line.endswith('\n'):
+                break
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+        return records
+
+    def pop_segment(self):
+        """
+        Remove the oldest segment and return its records, closing the
+        newest segment first if it is the only one. Returns an empty
+        list if the spool is empty.
+        """
+        if not self.segments:
+            self.rotate()
+        if not self.segments:
+            return []
+        segment = self.segments.pop(0)
+        records = self.read(segment)
+        os.unlink(self.path(segment))
+        return records
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+#
+# © 2011 SimpleGeo, Inc. All rights reserved.
+#
+
+"""Expose ostrich stats over HTTP from eventlet-based daemons."""
+
+import json
+
+import eventlet
+import eventlet.wsgi
+from ostrich import stats
+
+
+def stats_app(environ, start_response):
+    """
+    WSGI app returning the current ostrich stats as JSON. Pass
+    ?reset=1 to reset counters and timings after reading them.
+    """
+    reset = 'reset=1' in environ.get('QUERY_STRING', '')
+    body = json.dumps(stats.stats(reset=reset), default=stats.json_encoder)
+    start_response('200 OK', [('Content-Type', 'application/json'),
+                              ('Content-Length', str(len(body) + 1))])
+    return [body, '\n']
+
+
+def serve_stats(port, host='0.0.0.0'):
+    """Serve stats_app on port in a background greenthread."""
+    return eventlet.spawn(eventlet.wsgi.server,
+                          eventlet.listen((host, port)), stats_app)